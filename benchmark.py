@@ -0,0 +1,536 @@
+"""
+benchmark.py
+Rough timings for the image module.  Run it from this directory with
+
+    python benchmark.py
+
+Each benchmark prints its own results.  They are meant for comparing two ways
+of doing the same thing on one machine, not as absolute numbers.
+
+To catch the module getting slower, run the suite, which times loading, pixel
+access, copying, saving and drawing with PIL and without it, and saves the
+times as JSON:
+
+    python benchmark.py --json before.json
+    ... change or upgrade something ...
+    python benchmark.py --json after.json
+    python benchmark.py --compare before.json after.json
+
+--compare lists every time that grew by more than --threshold (default 0.25,
+that is 25%) and exits with status 1 if there are any.  Drawing is only timed
+when there is a display; without one, Xvfb is used if it is installed.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+if __name__ == '__main__' and "--no-pil" in sys.argv:
+    sys.modules['PIL'] = None     # image falls back to its own buffer code
+import image
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def _timeInChild(code, env=None, repeat=5):
+    """Run code in a fresh interpreter repeat times and return the best time it reports."""
+    best = None
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], cwd=here, env=env,
+                             capture_output=True, text=True)
+        if out.returncode != 0:
+            return None
+        t = float(out.stdout.split()[-1])
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def benchImport(repeat=5):
+    """Compare importing the module headless with importing it and creating the Tk root,
+    which is what every import used to do."""
+    headlessEnv = dict(os.environ, CIMAGE_HEADLESS="1")
+    lazy = _timeInChild("import time; t = time.perf_counter(); import image; "
+                        "print(time.perf_counter() - t)", headlessEnv, repeat)
+    eager = _timeInChild("import time; t = time.perf_counter(); import image; image._getRoot(); "
+                         "print(time.perf_counter() - t)", None, repeat)
+    if lazy is None:
+        print("import image (headless):       failed")
+    else:
+        print("import image (headless):       %8.2f ms" % (lazy * 1000))
+    if eager is None:
+        print("import image + Tk root:        skipped (no display)")
+    else:
+        print("import image + Tk root:        %8.2f ms" % (eager * 1000))
+
+
+def _rate(label, pixels, seconds):
+    print("%-30s %8.3f s  %12.0f pixels/s" % (label, seconds, pixels / seconds))
+
+
+def benchRegion(fname="lcastle.png"):
+    """Compare reading and writing every pixel one at a time with getPixels/setPixels."""
+    img = image.FileImage(os.path.join(here, fname))
+    width, height = img.getWidth(), img.getHeight()
+    pixels = width * height
+
+    t = time.perf_counter()
+    for row in range(height):
+        for col in range(width):
+            img.setPixel(col, row, img.getPixel(col, row))
+    _rate("getPixel/setPixel loop:", pixels, time.perf_counter() - t)
+
+    t = time.perf_counter()
+    img.setPixels(0, 0, width, height, img.getPixels())
+    _rate("getPixels/setPixels:", pixels, time.perf_counter() - t)
+
+
+def benchMapChannels(fname="lcastle.png"):
+    """Compare computing the negative with a getPixel/setPixel loop and with mapChannels."""
+    img = image.FileImage(os.path.join(here, fname))
+    width, height = img.getWidth(), img.getHeight()
+    pixels = width * height
+
+    t = time.perf_counter()
+    for row in range(height):
+        for col in range(width):
+            p = img.getPixel(col, row)
+            img.setPixel(col, row, image.Pixel(255 - p.getRed(), 255 - p.getGreen(), 255 - p.getBlue()))
+    _rate("negative, pixel loop:", pixels, time.perf_counter() - t)
+
+    t = time.perf_counter()
+    img.mapChannels(lambda v: 255 - v)
+    _rate("negative, mapChannels:", pixels, time.perf_counter() - t)
+
+
+def benchToList(fname="lcastle.png"):
+    """Measure the memory allocations and time of toList, which makes a Pixel per pixel."""
+    img = image.FileImage(os.path.join(here, fname))
+    img.getPixels()     # make sure the file is fully decoded first
+    pixels = img.getWidth() * img.getHeight()
+
+    tracemalloc.start()
+    res = img.toList()
+    size = tracemalloc.get_traced_memory()[0]
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+    del res
+    print("toList allocations:            %8.2f blocks/pixel %8.1f bytes/pixel"
+          % (blocks / pixels, size / pixels))
+
+    t = time.perf_counter()
+    img.toList()
+    _rate("toList:", pixels, time.perf_counter() - t)
+
+
+def _makeLargeJpeg(fname, scale=10):
+    """Write a jpeg scale times the size of lcastle.jpg, for load benchmarks"""
+    big = image.FileImage(os.path.join(here, "lcastle.jpg"))
+    big.im = big.im.resize((big.getWidth() * scale, big.getHeight() * scale))
+    big.im.save(fname)
+
+
+def benchLoad(repeat=5):
+    """Compare reading just the size of a large jpeg, decoding all of it, decoding it
+    at reduced size with maxSize, and loading it again from the file cache."""
+    if not image.pilAvailable:
+        return
+    fd, fname = tempfile.mkstemp(suffix=".jpg")
+    os.close(fd)
+    _makeLargeJpeg(fname)
+    for label, load in (("FileImage size only:", lambda: image.FileImage(fname).getWidth()),
+                        ("FileImage full decode:", lambda: image.FileImage(fname).getPixels()),
+                        ("FileImage maxSize=(200,200):",
+                         lambda: image.FileImage(fname, maxSize=(200, 200)).getPixels())):
+        t = time.perf_counter()
+        for i in range(repeat):
+            load()
+        print("%-30s %8.2f ms" % (label, (time.perf_counter() - t) / repeat * 1000))
+    old = image.cacheImages(1 << 30)
+    try:
+        image.FileImage(fname).getPixels()
+        t = time.perf_counter()
+        for i in range(repeat):
+            image.FileImage(fname).getPixels()
+        print("%-30s %8.2f ms" % ("FileImage, cached:", (time.perf_counter() - t) / repeat * 1000))
+    finally:
+        image.cacheImages(0)
+        image.cacheImages(old)
+    os.remove(fname)
+
+
+def benchCopy(fname="lcastle.png", n=100):
+    """Measure the memory used by n copies of an image, with copy (shared until changed)
+    and with every copy made in full up front, the way copy used to work."""
+    img = image.FileImage(os.path.join(here, fname))
+    shape = (img.getHeight(), img.getWidth(), 3)
+    data = img.getPixels()
+    # PIL's memory is invisible to tracemalloc, so full copies are made as in-memory images
+    fullCopy = lambda: image.ArrayImage(memoryview(bytearray(data)).cast("B", shape))
+    for label, makeCopy in (("copy-on-write copy:", img.copy), ("full copy:", fullCopy)):
+        tracemalloc.start()
+        t = time.perf_counter()
+        copies = [makeCopy() for i in range(n)]
+        seconds = time.perf_counter() - t
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del copies
+        print("%-30s %8.3f s  %12.0f bytes per copy" % (label, seconds, size / n))
+
+
+def grayPixel(p):
+    avg = (p.getRed() + p.getGreen() + p.getBlue()) // 3
+    return image.Pixel(avg, avg, avg)
+
+
+def benchParallelMap(workers=None):
+    """Compare mapPixels with parallelMap on a large image."""
+    if not image.pilAvailable:
+        return
+    fd, fname = tempfile.mkstemp(suffix=".jpg")
+    os.close(fd)
+    _makeLargeJpeg(fname, 5)
+    img = image.FileImage(fname)
+    pixels = img.getWidth() * img.getHeight()
+    img.getPixels()
+
+    t = time.perf_counter()
+    img.mapPixels(grayPixel)
+    _rate("mapPixels:", pixels, time.perf_counter() - t)
+
+    t = time.perf_counter()
+    img.parallelMap(grayPixel, workers)
+    _rate("parallelMap (%d workers):" % (workers or os.cpu_count()), pixels, time.perf_counter() - t)
+    os.remove(fname)
+
+
+def benchConvolve(fname="lcastle.png"):
+    """Compare a 3x3 blur written with getPixel/setPixel with blur, and time larger blurs,
+    which are separable and done in two passes."""
+    img = image.FileImage(os.path.join(here, fname))
+    width, height = img.getWidth(), img.getHeight()
+    pixels = width * height
+
+    t = time.perf_counter()
+    res = image.EmptyImage(width, height)
+    for row in range(height):
+        for col in range(width):
+            sums = [0, 0, 0]
+            for y in range(max(row - 1, 0), min(row + 2, height)):
+                for x in range(max(col - 1, 0), min(col + 2, width)):
+                    p = img.getPixel(x, y)
+                    sums[0] += p.getRed()
+                    sums[1] += p.getGreen()
+                    sums[2] += p.getBlue()
+            n = (min(row + 2, height) - max(row - 1, 0)) * (min(col + 2, width) - max(col - 1, 0))
+            res.setPixel(col, row, image.Pixel(sums[0] // n, sums[1] // n, sums[2] // n))
+    _rate("3x3 blur, pixel loop:", pixels, time.perf_counter() - t)
+
+    for radius in (1, 5, 15):
+        t = time.perf_counter()
+        img.blur(radius)
+        _rate("blur(%d):" % radius, pixels, time.perf_counter() - t)
+
+
+def double(oldimage):
+    """Double the size of an image the way double.py does, one pixel at a time"""
+    newim = image.EmptyImage(oldimage.getWidth() * 2, oldimage.getHeight() * 2)
+    for row in range(newim.getHeight()):
+        for col in range(newim.getWidth()):
+            newim.setPixel(col, row, oldimage.getPixel(col // 2, row // 2))
+    return newim
+
+
+def benchResize(fname="lcastle.png"):
+    """Compare doubling the size of an image with double.py's pixel loop and with resize."""
+    img = image.FileImage(os.path.join(here, fname))
+    width, height = img.getWidth(), img.getHeight()
+    pixels = width * height * 4
+
+    t = time.perf_counter()
+    double(img)
+    _rate("double, pixel loop:", pixels, time.perf_counter() - t)
+
+    for method in ("nearest", "bilinear"):
+        t = time.perf_counter()
+        img.resize(width * 2, height * 2, method)
+        _rate("resize, %s:" % method, pixels, time.perf_counter() - t)
+
+
+def benchArithmetic(fname="lcastle.png"):
+    """Compare adding and blending two images with getPixel/setPixel loops and with the
+    image operators, which work on the whole image at once."""
+    img = image.FileImage(os.path.join(here, fname))
+    other = img.flipH()
+    width, height = img.getWidth(), img.getHeight()
+    pixels = width * height
+
+    t = time.perf_counter()
+    res = image.EmptyImage(width, height)
+    for row in range(height):
+        for col in range(width):
+            p, q = img.getPixel(col, row), other.getPixel(col, row)
+            res.setPixel(col, row, image.Pixel(min(p.getRed() + q.getRed(), 255),
+                                               min(p.getGreen() + q.getGreen(), 255),
+                                               min(p.getBlue() + q.getBlue(), 255)))
+    _rate("add, pixel loop:", pixels, time.perf_counter() - t)
+
+    t = time.perf_counter()
+    img + other
+    _rate("img + other:", pixels, time.perf_counter() - t)
+
+    t = time.perf_counter()
+    res = image.EmptyImage(width, height)
+    for row in range(height):
+        for col in range(width):
+            p, q = img.getPixel(col, row), other.getPixel(col, row)
+            res.setPixel(col, row, image.Pixel(int(p.getRed() * 0.7 + q.getRed() * 0.3),
+                                               int(p.getGreen() * 0.7 + q.getGreen() * 0.3),
+                                               int(p.getBlue() * 0.7 + q.getBlue() * 0.3)))
+    _rate("blend, pixel loop:", pixels, time.perf_counter() - t)
+
+    t = time.perf_counter()
+    img.blend(other, 0.3)
+    _rate("blend:", pixels, time.perf_counter() - t)
+
+
+def _best(func, repeat=3):
+    """Return the shortest time, in seconds, of repeat calls of func"""
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        func()
+        t = time.perf_counter() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def _syntheticImage(width, height):
+    """Return an EmptyImage filled with a repeating pattern of colors"""
+    size = width * height * 3
+    pattern = bytes(range(0, 256, 3)) + bytes(range(255, 0, -5))
+    data = (pattern * (size // len(pattern) + 1))[:size]
+    img = image.EmptyImage(width, height)
+    img.setPixels(0, 0, width, height, data)
+    return img
+
+
+def _hasDisplay():
+    """Return True if Tk windows can be made"""
+    try:
+        image._getRoot()
+    except Exception:
+        return False
+    return True
+
+
+def _pixelLoops(img):
+    """Return the times of a getPixel loop and a setPixel loop over img"""
+    width, height = img.getWidth(), img.getHeight()
+    p = image.Pixel(10, 20, 30)
+
+    def getLoop():
+        for row in range(height):
+            for col in range(width):
+                img.getPixel(col, row)
+
+    def setLoop():
+        for row in range(height):
+            for col in range(width):
+                img.setPixel(col, row, p)
+
+    return _best(getLoop), _best(setLoop)
+
+
+def _drawTimes(img, frames=50):
+    """Return the times of the first draw of img, and the average time of a redraw
+    after changing one pixel and after changing every pixel"""
+    width, height = img.getWidth(), img.getHeight()
+    win = image.ImageWin(width, height, "benchmark")
+    try:
+        t = time.perf_counter()
+        img.draw(win)
+        first = time.perf_counter() - t
+
+        t = time.perf_counter()
+        for i in range(frames):
+            img.setPixel(i % width, 0, image.Pixel(i % 256, 0, 0))
+            img.draw(win)
+        onePixel = (time.perf_counter() - t) / frames
+
+        data = img.getPixels()
+        t = time.perf_counter()
+        for i in range(frames):
+            img.setPixels(0, 0, width, height, data)
+            img.draw(win)
+        allPixels = (time.perf_counter() - t) / frames
+    finally:
+        win._close()
+    return first, onePixel, allPixels
+
+
+def runSuite(repeat=5):
+    """Time the main operations of the image module with the backend it was imported
+    with, and return a dictionary of benchmark name to seconds"""
+    results = {}
+    code = "import time; t = time.perf_counter(); import image; print(time.perf_counter() - t)"
+    if not image.pilAvailable:
+        code = "import sys; sys.modules['PIL'] = None; " + code
+    seconds = _timeInChild(code, dict(os.environ, CIMAGE_HEADLESS="1"), repeat)
+    if seconds is not None:     # None if the child failed
+        results["import"] = seconds
+
+    display = _hasDisplay()
+    formats = ["ppm"]
+    if image.pilAvailable:
+        formats = ["png", "jpg", "gif", "ppm"]
+    elif display:
+        formats = ["gif", "ppm"]
+    for ext in formats:
+        fname = os.path.join(here, "lcastle." + ext)
+        if os.path.exists(fname):
+            results["load lcastle." + ext] = _best(lambda: image.FileImage(fname).getPixels())
+
+    small = _syntheticImage(400, 300)
+    results["getPixel loop 400x300"], results["setPixel loop 400x300"] = _pixelLoops(small)
+    results["getPixels 400x300"] = _best(small.getPixels)
+    results["toList 400x300"] = _best(small.toList)
+
+    large = _syntheticImage(1600, 1200)
+    results["copy and change 1600x1200"] = _best(lambda: large.copy().setPixel(0, 0, image.Pixel(0, 0, 0)))
+    tempdir = tempfile.mkdtemp()
+    try:
+        for ext in formats:
+            fname = os.path.join(tempdir, "large." + ext)
+            results["save 1600x1200 " + ext] = _best(lambda: large.save(fname))
+            results["load 1600x1200 " + ext] = _best(lambda: image.FileImage(fname).getPixels())
+    finally:
+        shutil.rmtree(tempdir)
+
+    if display:
+        first, onePixel, allPixels = _drawTimes(small)
+        results["draw first 400x300"] = first
+        results["draw one pixel changed 400x300"] = onePixel
+        results["draw all changed 400x300"] = allPixels
+    return results
+
+
+def _startXvfb():
+    """Start a virtual X display if there is no display and Xvfb is installed.
+    Returns the Xvfb process and the value for DISPLAY, or (None, None)."""
+    if os.environ.get("DISPLAY") or sys.platform in ("win32", "darwin") or not shutil.which("Xvfb"):
+        return None, None
+    readEnd, writeEnd = os.pipe()
+    proc = subprocess.Popen(["Xvfb", "-displayfd", str(writeEnd), "-screen", "0", "1024x768x24",
+                             "-nolisten", "tcp"], pass_fds=(writeEnd,),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.close(writeEnd)
+    with os.fdopen(readEnd) as f:
+        number = f.readline().strip()
+    if not number:
+        proc.kill()
+        return None, None
+    return proc, ":" + number
+
+
+def runAllSuites():
+    """Run the suite with PIL and without it, each in its own interpreter, and return
+    the results keyed by backend"""
+    xvfb, display = _startXvfb()
+    env = dict(os.environ)
+    if display:
+        env["DISPLAY"] = display
+    results = {}
+    try:
+        for backend, args in (("pil", []), ("nopil", ["--no-pil"])):
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--backend"] + args,
+                                 cwd=here, env=env, capture_output=True, text=True)
+            if out.returncode != 0:
+                print("%s suite failed:\n%s" % (backend, out.stderr), file=sys.stderr)
+                continue
+            results[backend] = json.loads(out.stdout)
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+            xvfb.wait()
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}
+
+
+def compare(oldFile, newFile, threshold=0.25):
+    """Print the times in two suite JSON files side by side, marking those that grew by
+    more than threshold (a fraction).  Returns the number of such regressions."""
+    with open(oldFile) as f:
+        old = json.load(f)["results"]
+    with open(newFile) as f:
+        new = json.load(f)["results"]
+    regressions = 0
+    for backend in sorted(set(old) & set(new)):
+        print("%s:" % backend)
+        # benchmarks that failed to run may have been saved as null; leave them out
+        for name in sorted(name for name in set(old[backend]) | set(new[backend])
+                           if old[backend].get(name, 0) is not None
+                           and new[backend].get(name, 0) is not None):
+            before = old[backend].get(name)
+            after = new[backend].get(name)
+            if before is None or after is None:
+                print("  %-34s %s" % (name, "only in " + (oldFile if after is None else newFile)))
+                continue
+            change = after / before - 1 if before else 0
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print("  %-34s %10.4f s %10.4f s %+7.1f%%%s" % (name, before, after, change * 100, flag))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Time the image module.  With no options, "
+                                     "print comparisons of slow and fast ways of doing things.")
+    parser.add_argument("--json", metavar="FILE",
+                        help="run the suite with and without PIL and save the times in FILE")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two files saved with --json")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="how much slower, as a fraction, counts as a regression (default 0.25)")
+    parser.add_argument("--backend", action="store_true",
+                        help="run the suite once in this process and print the times as JSON")
+    parser.add_argument("--no-pil", action="store_true", help="run without PIL")
+    args = parser.parse_args(args)
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+    if args.backend:
+        print(json.dumps(runSuite()))
+    elif args.json:
+        results = runAllSuites()
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        for backend in sorted(results["results"]):
+            print("%s:" % backend)
+            for name, seconds in sorted(results["results"][backend].items()):
+                print("  %-34s %10.4f s" % (name, seconds))
+    else:
+        benchImport()
+        benchRegion()
+        benchMapChannels()
+        benchToList()
+        benchLoad()
+        benchCopy()
+        benchParallelMap()
+        benchConvolve()
+        benchResize()
+        benchArithmetic()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,8 @@ def double(oldimage):
 
     newim = EmptyImage(oldw*2,oldh*2)
 
-    for row in range(newim.getWidth()):   #// \label{lst:dib1}
-        for col in range(newim.getHeight()): #// \label{lst:dib2}
+    for row in range(newim.getHeight()):   #// \label{lst:dib1}
+        for col in range(newim.getWidth()): #// \label{lst:dib2}
             
             originalCol = col//2  #// \label{lst:dib3}
             originalRow = row//2  #// \label{lst:dib4}
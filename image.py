@@ -77,34 +77,120 @@ which serves a similar purpose in the graphics primitive world.
 #   Add autoShow function that can be used to get and optionally set a flag
 #     that if True makes images automatically be displayed when their printed
 #     representation is produced (e.g. as results in the shell).
+#
+# Version 2.1
+# Changes:
+#   The Tk root window is created the first time a window is needed rather than
+#     at import time.  Add a headless mode (the headless function or the
+#     CIMAGE_HEADLESS environment variable) for loading, changing and saving
+#     images on machines without a display.
+#   Add getPixels and setPixels to read and write a whole region of pixels as
+#     bytes in one call.
+#   Add toArray and ArrayImage (or fromArray) to share pixels with numpy arrays.
+#   Add mapChannels to change every pixel with one function per color, using a lookup
+#     table instead of a loop over the pixels.
+#   Drawing an image again in the same window reuses its photo and canvas item instead
+#     of adding new ones.  Add undraw; closing a window also frees its images.
+#   Images remember the box of pixels changed since they were last drawn, and a redraw
+#     only copies that part to the window.
+#   Pixel uses __slots__, and pixels read from an image skip the value checks.
+#   Without PIL, images keep their pixels in memory instead of a Tk PhotoImage, and are
+#     copied to Tk in one call when drawn.  ppm files are read and written without Tk.
+#   FileImage only reads the size of the image until its pixels are used, and can
+#     shrink large images as they are loaded (maxSize and scale).
+#   copy and clone return an image of the same class, which shares its pixels with the
+#     original until one of them changes.
+#   Add mapPixels and parallelMap to make a new image by applying a function to every
+#     pixel, parallelMap spreading the work over several processes.
+#   Add a command line mode (python -m image, or the cimage command) that applies a
+#     transform to many image files using a pool of worker processes.
+#   Add convolve, blur, sharpen and sobel filters.
+#   Add resize, crop, flipH, flipV and rotate90, which make a new image in one step.
+#   Add profile, which counts and times the calls of the main operations.
+#   setDelay is no longer a stub: once the image is drawn, it is redrawn after every
+#     interval setPixel calls (or at most fps times a second), waiting delay
+#     milliseconds after each frame.
+#   getMouse and exitOnClick wait in Tk's event loop instead of checking for a click
+#     over and over, which kept a CPU busy.  Add getKey, getEvent (a queue of clicks
+#     and keys) and the coroutines mouse and key for use with asyncio.
+#   Add histogram, mean and extrema, which are remembered until the image changes.
+#   Add MappedImage, which works on the pixels of a ppm or raw rgb file through a
+#     memory map, and tiles, to go over a large image one tile at a time.
+#   Images can have mode "L" (grayscale, one byte per pixel) or "RGBA" as well as
+#     "RGB": give mode to FileImage or EmptyImage, or use convert.  Pixels have an
+#     alpha value for RGBA images.
+#   Images can be added, subtracted and multiplied (img1 + img2, img * 1.5), and mixed
+#     with blend and composite, all in one step for the whole image.
+#   Images show up in notebooks such as Jupyter as png previews (shrunk to fit in
+#     previewSize), which are remembered until the image changes.  autoShow opens a
+#     window only the first time an image is shown, and never in headless mode.
+#   save raises errors instead of printing them, uses ftype even when the file name has
+#     a suffix, and takes quality (jpg) and compress_level (png).  Add saveAsync, which
+#     saves a copy of the image in a background thread, and toBytes.  Without PIL,
+#     png files can be written.
+#   Add cacheImages, which keeps decoded image files so loading one again just shares
+#     its pixels, and cacheStats.
+
+import collections
+import itertools
+import operator
+import os
+import time
+import weakref
 
 try:
     import tkinter
 except:
-    import Tkinter as tkinter
+    try:
+        import Tkinter as tkinter
+    except:
+        tkinter = None
 
 pilAvailable = True
 try:
     from PIL import Image as PIL_Image
-    from PIL import ImageTk
 except:
     pilAvailable = False
 
 #import exceptions
 
 # Borrow some ideas from Zelle
-# create an invisible global main root for all windows
+# an invisible global main root for all windows.  It is created by _getRoot the
+# first time a window is needed, so importing the module never touches the display.
 tk = tkinter
-_imroot = tk.Tk()
-_imroot.withdraw()
+_imroot = None
+
+# Headless mode never creates the root, so it works where there is no display
+# (or no tkinter at all).  Images can still be loaded, changed and saved.
+headlessOn = tkinter is None or os.environ.get("CIMAGE_HEADLESS", "") not in ("", "0")
+
+def headless(newSetting=None):
+    """Return and optionally change the True/False headless setting"""
+    global headlessOn
+    oldSetting = headlessOn
+    if newSetting != None:
+        if not newSetting and tkinter is None:
+            raise RuntimeError("Error: headless mode can not be turned off, tkinter is not available")
+        headlessOn = newSetting
+    return oldSetting
 
-# Make sure the displayed window is on top - otherwise drawing can appear to fail.
-# The _imroot.lift() call was required on Windows 7 - Linux was fine without it
-# not sure about Mac, but there are some tips at
-# http://stackoverflow.com/questions/8691655/how-to-put-a-tkinter-window-on-top-of-the-others
-_imroot.lift()
-#_imroot.call('wm', 'attributes', '.', '-topmost', True)
-#_imroot.after_idle(_imroot.call, 'wm', 'attributes', '.', '-topmost', False)
+def _getRoot():
+    """Return the invisible root window, creating it on first use."""
+    global _imroot
+    if _imroot is None:
+        if headlessOn:
+            raise RuntimeError("Error: windows and Tk images are not available in headless mode")
+        _imroot = tk.Tk()
+        _imroot.withdraw()
+
+        # Make sure the displayed window is on top - otherwise drawing can appear to fail.
+        # The _imroot.lift() call was required on Windows 7 - Linux was fine without it
+        # not sure about Mac, but there are some tips at
+        # http://stackoverflow.com/questions/8691655/how-to-put-a-tkinter-window-on-top-of-the-others
+        _imroot.lift()
+        #_imroot.call('wm', 'attributes', '.', '-topmost', True)
+        #_imroot.after_idle(_imroot.call, 'wm', 'attributes', '.', '-topmost', False)
+    return _imroot
 
 
 # For backward compatibility, the new autoShow feature is off by default:
@@ -118,13 +204,519 @@ def autoShow(newSetting=None):
         autoShowOn = newSetting
     return oldSetting
 
+def _fitSize(size, maxSize=None, scale=None):
+    """Return the (width, height) an image of the given size is shrunk to, either to fit
+    in the maxSize box or by the scale factor, keeping its shape"""
+    width, height = size
+    if maxSize is None and scale is None:
+        return size
+    if maxSize is not None and scale is not None:
+        raise ValueError("Error: give maxSize or scale, not both")
+    if maxSize is not None:
+        if (not isinstance(maxSize, (tuple, list)) or len(maxSize) != 2
+                or not all(isinstance(m, int) for m in maxSize)):
+            raise TypeError("Error: maxSize %r is not a (width, height) pair of integers" % (maxSize,))
+        if not all(m > 0 for m in maxSize):
+            raise ValueError("Error: maxSize %r is not positive" % (maxSize,))
+        scale = min(maxSize[0] / width, maxSize[1] / height, 1)
+    elif not isinstance(scale, (int, float)):
+        raise TypeError("Error: scale %r is not a number" % scale)
+    elif not 0 < scale <= 1:
+        raise ValueError("Error: scale %r is not between 0 and 1" % scale)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def _resizeNearest(data, size, newSize, bands=3):
+    """Return pixel bytes of the given size resized to newSize by repeating or dropping
+    pixels.  Each pixel is bands bytes."""
+    width, height = size
+    newWidth, newHeight = newSize
+    if size == newSize:
+        return data
+    data = bytes(data)
+    # the pixel nearest the center of each new pixel
+    columns = [((2 * x + 1) * width // (2 * newWidth)) * bands for x in range(newWidth)]
+    rowbytes = width * bands
+    res = bytearray()
+    lastRow = None
+    for y in range(newHeight):
+        row = (2 * y + 1) * height // (2 * newHeight)
+        if row != lastRow:
+            line = data[row * rowbytes:(row + 1) * rowbytes]
+            newLine = b"".join([line[i:i + bands] for i in columns])
+            lastRow = row
+        res += newLine
+    return res
+
+def _resizeBilinear(data, size, newSize, bands=3):
+    """Return pixel bytes of the given size resized to newSize, each new pixel a weighted
+    average of the four old pixels nearest its center"""
+    width, height = size
+    newWidth, newHeight = newSize
+    data = bytes(data)
+
+    def weights(n, newN):
+        # the two old pixels on either side of the center of each new pixel, and how far
+        # the center is from the first towards the second
+        res = []
+        for i in range(newN):
+            pos = min(max((i + 0.5) * n / newN - 0.5, 0), n - 1)
+            low = int(pos)
+            res.append((low, min(low + 1, n - 1), pos - low))
+        return res
+
+    columns = [(low * bands + c, high * bands + c, f) for low, high, f in weights(width, newWidth)
+               for c in range(bands)]
+    rowbytes = width * bands
+
+    def stretch(row):
+        line = data[row * rowbytes:(row + 1) * rowbytes]
+        return [line[a] + (line[b] - line[a]) * f for a, b, f in columns]
+
+    lines = {}
+    res = bytearray()
+    for low, high, f in weights(height, newHeight):
+        # each old row is stretched across once and kept while new rows still need it
+        lines = {row: lines[row] if row in lines else stretch(row) for row in (low, high)}
+        res += bytes([int(a + (b - a) * f + 0.5) for a, b in zip(lines[low], lines[high])])
+    return res
+
+def _reverseRows(data, width, bands=3):
+    """Return pixel bytes with the rows in the opposite order"""
+    rowbytes = width * bands
+    return bytearray(b"".join([data[start:start + rowbytes]
+                               for start in range(len(data) - rowbytes, -1, -rowbytes)]))
+
+def _reversePixels(data, bands=3):
+    """Return pixel bytes with the pixels in the opposite order, which turns an image
+    upside down"""
+    backwards = bytes(data)[::-1]
+    res = bytearray(len(backwards))
+    for c in range(bands):
+        res[c::bands] = backwards[bands - 1 - c::bands]
+    return res
+
+def _transpose(data, width, height, bands=3):
+    """Return pixel bytes whose rows are the columns of the width by height image in data"""
+    data = bytes(data)
+    rowbytes = width * bands
+    res = bytearray()
+    column = bytearray(height * bands)
+    for x in range(0, rowbytes, bands):
+        for c in range(bands):
+            column[c::bands] = data[x + c::rowbytes]
+        res += column
+    return res
+
+# the modes an image can have, and the bytes each of their pixels takes
+_modeBands = {"L": 1, "RGB": 3, "RGBA": 4}
+
+def _checkMode(mode):
+    if mode not in _modeBands:
+        raise ValueError("Error: mode %r is not one of 'RGB', 'L' (grayscale) or 'RGBA'" % (mode,))
+    return _modeBands[mode]
+
+def _gray(red, green, blue):
+    """Return the brightness of a color, weighted the way PIL converts to L"""
+    return (red * 19595 + green * 38470 + blue * 7471 + 0x8000) >> 16
+
+def _pixelValues(pixel, bands):
+    """Return what a Pixel is stored as in an image with bands bytes per pixel: its
+    gray value for 1, its (red, green, blue, alpha) for 4"""
+    if bands == 1:
+        return _gray(*pixel.getColorTuple())
+    return pixel.getColorTuple() + (pixel.getAlpha(),)
+
+def _convertData(data, bands, newBands):
+    """Return pixel bytes with bands bytes per pixel (1 gray, 3 rgb or 4 rgba) converted
+    to newBands per pixel: colors become gray, gray is copied to all three colors,
+    alpha is dropped or added as 255 (opaque)."""
+    if bands == newBands:
+        return data
+    pixels = len(data) // bands
+    if newBands == 1:
+        numpy = _numpy()
+        if numpy is not None:
+            rgb = numpy.frombuffer(data, numpy.uint8).reshape(pixels, bands)[:, :3].astype(numpy.uint32)
+            return bytearray(((rgb * [19595, 38470, 7471]).sum(axis=1) + 0x8000 >> 16)
+                             .astype(numpy.uint8).tobytes())
+        data = bytes(data)
+        return bytearray(map(_gray, data[0::bands], data[1::bands], data[2::bands]))
+    res = bytearray(b"\xff") * (pixels * newBands)
+    for c in range(3):
+        res[c::newBands] = data[0::bands] if bands == 1 else data[c::bands]
+    return res
+
+def _readPPMHeader(f):
+    """Read the header of the binary ppm (P6) or pgm (P5) file f, leaving f at the
+    first pixel.  Returns the width, height and number of bytes per pixel (3 or 1)."""
+    magic = f.read(2)
+    if magic not in (b'P6', b'P5'):
+        raise ValueError("Error: %s is not a binary ppm or pgm file" % getattr(f, 'name', f))
+    numbers = []
+    while len(numbers) < 3:
+        c = f.read(1)
+        if c == b'#':
+            f.readline()
+        elif c.isdigit():
+            # a number ends with a single whitespace character
+            while c[-1:].isdigit():
+                more = f.read(1)
+                if more == b'':
+                    raise ValueError("Error: %s ends in the middle of its header"
+                                     % getattr(f, 'name', f))
+                c += more
+            numbers.append(int(c[:-1]))
+        elif c == b'':
+            raise ValueError("Error: %s ends in the middle of its header" % getattr(f, 'name', f))
+    width, height, maxval = numbers
+    if maxval != 255:
+        raise ValueError("Error: only ppm files with 255 as their maximum value can be read, not %d"
+                         % maxval)
+    return width, height, 3 if magic == b'P6' else 1
+
+def _readPPMPixels(f, width, height, bands):
+    """Read the pixels following the header of a ppm or pgm file, bands bytes each"""
+    data = f.read(width * height * bands)
+    if len(data) != width * height * bands:
+        raise ValueError("Error: %s is missing some of its pixels" % getattr(f, 'name', f))
+    return bytearray(data)
+
+def _pngBytes(data, width, height, bands, level=-1):
+    """Return the pixel bytes data, bands bytes per pixel, encoded as a png file,
+    compressed by zlib at level (0 to 9, -1 for zlib's default)"""
+    import struct
+    import zlib
+
+    def chunk(kind, body):
+        return (struct.pack(">I", len(body)) + kind + body
+                + struct.pack(">I", zlib.crc32(kind + body)))
+
+    colorType = {1: 0, 3: 2, 4: 6}[bands]
+    rowlen = width * bands
+    data = memoryview(data)
+    # each row starts with its filter type, 0 for none
+    rows = b"".join(b"\0" + data[start:start + rowlen] for start in range(0, rowlen * height, rowlen))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, colorType, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows, level))
+            + chunk(b"IEND", b""))
+
+# background threads for saveAsync, and the number of saves that can be waiting at once
+_saveWorkers = min(4, os.cpu_count() or 1)
+_savePool = None
+_saveSlots = None
+
+def _saveExecutor():
+    """Return the pool of threads that saveAsync uses and the semaphore limiting its queue"""
+    global _savePool, _saveSlots
+    if _savePool is None:
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        _savePool = ThreadPoolExecutor(_saveWorkers, thread_name_prefix="image-save")
+        _saveSlots = threading.BoundedSemaphore(_saveWorkers * 2)
+    return _savePool, _saveSlots
+
+def _saveOptions(quality, compress_level):
+    """Return the encoder options given, by name"""
+    options = {}
+    if quality is not None:
+        options["quality"] = quality
+    if compress_level is not None:
+        options["compress_level"] = compress_level
+    return options
+
+def _photoPixels(photo, x, y, w, h):
+    """Return the pixels of a region of a Tk photo as rgb bytes"""
+    # one Tcl call returns the whole region as rows of #rrggbb colors
+    colors = photo.tk.call(photo.name, "data", "-from", x, y, x + w, y + h)
+    rows = photo.tk.splitlist(colors)
+    hexcodes = [c for row in rows for c in photo.tk.splitlist(row)]
+    return bytearray.fromhex("".join(hexcodes).replace("#", ""))
+
+def _putRGB(photo, data, width, height, x=0, y=0):
+    """Copy width by height rgb bytes into a Tk photo at x,y in one call"""
+    try:
+        ppm = b"P6\n%d %d\n255\n" % (width, height) + bytes(data)
+        photo.tk.call(photo.name, "put", ppm, "-format", "ppm", "-to", x, y)
+    except tkinter.TclError:
+        # this Tk can not read ppm data from memory, so send rows of colors instead
+        photo.put(_hexRows(data, width), to=(x, y))
+
+def _hexRows(data, width):
+    """Return rgb bytes as the rows of #rrggbb colors that PhotoImage.put expects"""
+    digits = memoryview(data).hex()
+    rowlen = width * 6
+    rows = []
+    for start in range(0, len(digits), rowlen):
+        line = digits[start:start + rowlen]
+        rows.append("{" + " ".join(["#" + line[i:i + 6] for i in range(0, rowlen, 6)]) + "}")
+    return " ".join(rows)
+
+def _channelTable(f):
+    """Tabulate f for every color value, returning the 256 results as bytes"""
+    table = []
+    for value in range(256):
+        newValue = f(value)
+        if not isinstance(newValue, int):
+            raise TypeError("Error: %r(%d) returned %r, which is not an integer" % (f, value, newValue))
+        if not 0 <= newValue <= 255:
+            raise ValueError("Error: %r(%d) returned %d, which is out of range" % (f, value, newValue))
+        table.append(newValue)
+    return bytes(table)
+
+def _translateChannels(data, tables):
+    """Look up every value of the pixel bytes data (a bytearray or memoryview) in its
+    channel's table, in place.  There is one table per byte of a pixel."""
+    data = memoryview(data)
+    bands = len(tables)
+    if tables.count(tables[0]) == bands:
+        data[:] = data.tobytes().translate(tables[0])
+    else:
+        for channel in range(bands):
+            data[channel::bands] = data[channel::bands].tobytes().translate(tables[channel])
+
+def _notPixel(func):
+    raise TypeError("Error: %r must return a Pixel" % func)
+
+def _mapPixelData(func, data, out, start, stop, bands=3):
+    """Call func on each pixel of the pixel bytes data[start:stop], putting the results
+    in the same place in out.  Only the use of func's results is checked, so errors
+    inside func show up as they are."""
+    make = Pixel._fromTrusted
+    values = []
+    add = values.extend
+    if bands == 3:
+        for i in range(start, stop, 3):
+            p = func(make(data[i], data[i + 1], data[i + 2]))
+            try:
+                add(p.getColorTuple())
+            except AttributeError:
+                _notPixel(func)
+    elif bands == 1:
+        for i in range(start, stop):
+            v = data[i]
+            p = func(make(v, v, v))
+            try:
+                values.append(_gray(*p.getColorTuple()))
+            except AttributeError:
+                _notPixel(func)
+    else:
+        for i in range(start, stop, 4):
+            p = func(make(data[i], data[i + 1], data[i + 2], data[i + 3]))
+            try:
+                add(p.getColorTuple())
+                values.append(p.getAlpha())
+            except AttributeError:
+                _notPixel(func)
+    out[start:stop] = bytes(values)
+
+def _mapBand(band):
+    """Work on one band of rows for parallelMap, in a worker process"""
+    func, sourceName, resultName, rowbytes, top, bottom, bands = band
+    from multiprocessing import shared_memory
+    source = shared_memory.SharedMemory(name=sourceName)
+    result = shared_memory.SharedMemory(name=resultName)
+    try:
+        _mapPixelData(func, source.buf, result.buf, top * rowbytes, bottom * rowbytes, bands)
+    finally:
+        source.close()
+        result.close()
+
+def _numpy():
+    """Return the numpy module, or None when it is not installed"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def _checkPositive(name, value):
+    """Make sure value, the argument called name, is an integer above 0"""
+    if not isinstance(value, int):
+        raise TypeError("Error: %s %r is not an integer" % (name, value))
+    if value <= 0:
+        raise ValueError("Error: %s %r is not positive" % (name, value))
+
+def _checkKernel(kernel):
+    """Make sure kernel is a list of rows of numbers with an odd number of rows and
+    columns, and return it as a list of lists"""
+    try:
+        kernel = [list(row) for row in kernel]
+    except TypeError:
+        raise TypeError("Error: kernel %r is not a list of rows" % (kernel,))
+    if not kernel or len(kernel) % 2 == 0 or len(kernel[0]) % 2 == 0:
+        raise ValueError("Error: kernel must have an odd number of rows and columns")
+    for row in kernel:
+        if len(row) != len(kernel[0]):
+            raise ValueError("Error: kernel rows must all be the same length")
+        for w in row:
+            if not isinstance(w, (int, float)):
+                raise TypeError("Error: kernel weight %r is not a number" % (w,))
+    return kernel
+
+def _separate(kernel):
+    """Return (column, row) lists of weights whose product is kernel, or None if there
+    are none.  A kernel that separates can be applied as two one-dimensional passes."""
+    pivot = None
+    for row in kernel:
+        for j, w in enumerate(row):
+            if w != 0:
+                pivot = row, j
+                break
+        if pivot:
+            break
+    if pivot is None:
+        return None
+    row, j = pivot
+    column = [r[j] / row[j] for r in kernel]
+    for c, r in zip(column, kernel):
+        for w, rw in zip(r, row):
+            if abs(w - c * rw) > 1e-9 * max(1, abs(w)):
+                return None
+    return column, row
+
+def _padEdges(im, r):
+    """Return the PIL image im with r more pixels on each side, copied from its edge pixels"""
+    width, height = im.size
+    padded = PIL_Image.new(im.mode, (width + 2 * r, height + 2 * r))
+    padded.paste(im, (r, r))
+    nearest = PIL_Image.NEAREST
+    padded.paste(im.crop((0, 0, 1, height)).resize((r, height), nearest), (0, r))
+    padded.paste(im.crop((width - 1, 0, width, height)).resize((r, height), nearest), (width + r, r))
+    top = padded.crop((0, r, width + 2 * r, r + 1))
+    padded.paste(top.resize((width + 2 * r, r), nearest), (0, 0))
+    bottom = padded.crop((0, height + r - 1, width + 2 * r, height + r))
+    padded.paste(bottom.resize((width + 2 * r, r), nearest), (0, height + r))
+    return padded
+
+def _correlateArray(numpy, data, width, height, kernel, bands=3):
+    """Return the weighted sums of kernel over the pixel bytes data as a height x width x
+    bands array of floats, repeating the edge pixels past the border"""
+    rows, cols = len(kernel), len(kernel[0])
+    pixels = numpy.frombuffer(data, numpy.uint8).reshape(height, width, bands).astype(numpy.float64)
+    padded = numpy.pad(pixels, ((rows // 2, rows // 2), (cols // 2, cols // 2), (0, 0)), mode='edge')
+    parts = _separate(kernel)
+    if parts is not None:
+        column, row = parts
+        across = sum(w * padded[:, j:j + width] for j, w in enumerate(row) if w)
+        return sum(w * across[i:i + height] for i, w in enumerate(column) if w)
+    return sum(w * padded[i:i + height, j:j + width]
+               for i, row in enumerate(kernel) for j, w in enumerate(row) if w)
+
+def _clampArray(numpy, values):
+    """Round an array of floats to the nearest byte values"""
+    return numpy.clip(numpy.floor(values + 0.5), 0, 255).astype(numpy.uint8).tobytes()
+
+def _correlateRows(data, width, height, kernel, bands=3):
+    """Yield the weighted sums of kernel over the pixel bytes data one row at a time, as
+    lists of floats, repeating the edge pixels past the border.  Only the rows the
+    kernel covers are kept in memory."""
+    rows, cols = len(kernel), len(kernel[0])
+    ry, rx = rows // 2, cols // 2
+    rowlen = width * bands
+
+    def paddedRow(y):
+        y = min(max(y, 0), height - 1)
+        line = list(data[y * rowlen:(y + 1) * rowlen])
+        return line[:bands] * rx + line + line[-bands:] * rx
+
+    def across(line, weights):
+        # each weight adds a copy of the row shifted by its column
+        sums = [0.0] * rowlen
+        for j, w in enumerate(weights):
+            if w:
+                sums = [s + w * v for s, v in zip(sums, line[bands * j:bands * j + rowlen])]
+        return sums
+
+    parts = _separate(kernel)
+    if parts is not None:
+        column, row = parts
+        done = {}   # rows already summed across; only those still needed are kept
+        for y in range(height):
+            sums = [0.0] * rowlen
+            for i, w in enumerate(column):
+                if w:
+                    k = y + i - ry
+                    if k not in done:
+                        done[k] = across(paddedRow(k), row)
+                    sums = [s + w * v for s, v in zip(sums, done[k])]
+            done.pop(y - ry, None)
+            yield sums
+    else:
+        for y in range(height):
+            sums = [0.0] * rowlen
+            for i, weights in enumerate(kernel):
+                if any(weights):
+                    part = across(paddedRow(y + i - ry), weights)
+                    sums = [s + v for s, v in zip(sums, part)]
+            yield sums
+
+def _clampRow(values):
+    """Round a list of floats to the nearest byte values"""
+    res = bytearray(len(values))
+    for k, v in enumerate(values):
+        v += 0.5
+        res[k] = 0 if v < 0 else 255 if v >= 255 else int(v)
+    return res
+
+def _combineData(op, data, other):
+    """Return a bytearray of the pixel bytes data and other added, subtracted or
+    multiplied (op), value by value, and kept between 0 and 255.  Multiplying divides
+    by 255, so white leaves a value as it is."""
+    numpy = _numpy()
+    if numpy is not None:
+        a = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int32)
+        b = numpy.frombuffer(other, dtype=numpy.uint8).astype(numpy.int32)
+        if op == "add":
+            res = numpy.minimum(a + b, 255)
+        elif op == "subtract":
+            res = numpy.maximum(a - b, 0)
+        else:
+            res = a * b // 255
+        return bytearray(res.astype(numpy.uint8).tobytes())
+    if op == "add":
+        return bytearray(map(min, map(operator.add, data, other), itertools.repeat(255)))
+    if op == "subtract":
+        return bytearray(map(max, map(operator.sub, data, other), itertools.repeat(0)))
+    return bytearray([a * b // 255 for a, b in zip(data, other)])
+
+def _blendData(data, other, alpha):
+    """Return a bytearray of the pixel bytes data mixed with other: alpha 0 gives data
+    and 1 gives other"""
+    numpy = _numpy()
+    if numpy is not None:
+        a = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.float64)
+        b = numpy.frombuffer(other, dtype=numpy.uint8)
+        return bytearray((a + alpha * (b - a)).astype(numpy.uint8).tobytes())
+    return bytearray([int(a + alpha * (b - a)) for a, b in zip(data, other)])
+
+def _compositeData(data, other, mask, bands):
+    """Return a bytearray of the pixel bytes data mixed with other by the one byte per
+    pixel mask: other where the mask is 255, data where it is 0"""
+    numpy = _numpy()
+    if numpy is not None:
+        a = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int32)
+        b = numpy.frombuffer(other, dtype=numpy.uint8).astype(numpy.int32)
+        m = numpy.repeat(numpy.frombuffer(mask, dtype=numpy.uint8).astype(numpy.int32), bands)
+        t = b * m + a * (255 - m) + 128
+        return bytearray((((t >> 8) + t) >> 8).astype(numpy.uint8).tobytes())
+    mask = itertools.chain.from_iterable(zip(*[bytes(mask)] * bands))
+    res = bytearray(len(data))
+    for k, (a, b, m) in enumerate(zip(data, other, mask)):
+        t = b * m + a * (255 - m) + 128
+        res[k] = ((t >> 8) + t) >> 8
+    return res
+
 def formatPixel(data):
     if type(data) == tuple:
         return '{#%02x%02x%02x}'%data
     elif isinstance(data,Pixel):
         return '{#%02x%02x%02x}'%data.getColorTuple()
 
-class ImageWin(tk.Canvas):
+# Without tkinter ImageWin can still be defined, but never constructed (see _getRoot)
+_Canvas = tk.Canvas if tk is not None else object
+
+class ImageWin(_Canvas):
     """
     ImageWin:  Make a frame to display one or more images.
     """
@@ -132,7 +724,8 @@ class ImageWin(tk.Canvas):
         """
         Create a window with a title, width and height.
         """
-        master = tk.Toplevel(_imroot)
+        root = _getRoot()   # first, so that without tkinter the error says why
+        master = tk.Toplevel(root)
         master.protocol("WM_DELETE_WINDOW", self._close)
         #super(ImageWin, self).__init__(master, width=width, height=height)
         tk.Canvas.__init__(self, master, width=width, height=height)
@@ -143,31 +736,145 @@ class ImageWin(tk.Canvas):
         self.items = []
         self.mouseX = None
         self.mouseY = None
+        self.lastKey = None
         self.bind("<Button-1>", self._onClick)
+        master.bind("<Key>", self._onKey)
         self.height = height
         self.width = width
         self._mouseCallback = None
         self.trans = None
-        _imroot.update()
+        self._images = {}   # images drawn in this window, by their cache id
+        # clicks and keys not yet read by getEvent, oldest first
+        self._events = collections.deque(maxlen=100)
+        # written on every click, key and close, to wake up waits in Tk's event loop
+        self._eventVar = tk.IntVar(master=self)
+        self._waiters = []  # (kind, future) for each mouse or key coroutine waiting
+        self._pumpCall = None   # the next call of _pump while coroutines are waiting
+        self._closed = False
+        _getRoot().update()
 
     def _close(self):
         """Close the window"""
+        if self._closed:
+            return
+        self._closed = True
+        for img in list(self._images.values()):
+            img.undraw(self)
+        self._wake(None, None)
         self.master.destroy()
         self.quit()
-        _imroot.update()
+        _getRoot().update()
+
+    def _wake(self, kind, value):
+        """Let waits for kind ("click" or "key") know it happened, with value.  kind None
+        means the window closed, which ends every wait."""
+        self._eventVar.set(self._eventVar.get() + 1)
+        for waiter in list(self._waiters):
+            if (kind is None or waiter[0] == kind) and not waiter[1].done():
+                waiter[1].set_result(value)
+
+    def _wait(self, done):
+        """Handle Tk events until done() is true or the window closes.  This sleeps in Tk's
+        event loop rather than checking over and over."""
+        while not done() and not self._closed:
+            self.wait_variable(self._eventVar)
+
+    def _consume(self, kind):
+        """Take the clicks or keys (kind) out of the getEvent queue, as they have been read
+        by getMouse, getKey, mouse or key"""
+        if any(event[0] == kind for event in self._events):
+            events = [event for event in self._events if event[0] != kind]
+            self._events.clear()
+            self._events.extend(events)
 
     def getMouse(self):
         """Wait for mouse click and return a tuple with x,y position in screen coordinates after
-        the click"""
+        the click.  If the window is closed while waiting, (None, None) is returned."""
         self.mouseX = None
         self.mouseY = None
-        while self.mouseX == None or self.mouseY == None:
-            self.update()
+        self._wait(lambda: self.mouseX is not None and self.mouseY is not None)
+        self._consume("click")
         return ((self.mouseX,self.mouseY))
 
     def get_mouse(self):
         return self.getMouse()
 
+    def getKey(self):
+        """Wait for a key to be pressed in the window and return its name, such as 'a',
+        'space' or 'Left'.  If the window is closed while waiting, None is returned."""
+        self.lastKey = None
+        self._wait(lambda: self.lastKey is not None)
+        self._consume("key")
+        return self.lastKey
+
+    def get_key(self):
+        return self.getKey()
+
+    def getEvent(self, timeout=None):
+        """Return the oldest click or key press that has not been read yet (by getEvent,
+        getMouse, getKey, mouse or key), waiting for one if there is none.  A click is returned as ('click', x, y) and a key as
+        ('key', name).  With timeout, give up after that many seconds and return None."""
+        if timeout is None:
+            self._wait(lambda: self._events)
+        else:
+            expired = []
+
+            def expire():
+                expired.append(True)
+                self._wake("timeout", None)
+
+            timer = self.after(int(timeout * 1000), expire)
+            self._wait(lambda: self._events or expired)
+            self.after_cancel(timer)
+        if self._events:
+            return self._events.popleft()
+        return None
+
+    def get_event(self, timeout=None):
+        return self.getEvent(timeout)
+
+    async def mouse(self):
+        """Wait for a mouse click without blocking other asyncio tasks, and return its x,y
+        position:  x, y = await win.mouse()
+        Tk has no way to wake asyncio up, so while a coroutine waits, the window's events
+        are handled from the event loop every 10 milliseconds."""
+        return await self._next("click")
+
+    async def key(self):
+        """Wait for a key press without blocking other asyncio tasks, and return its name:
+        name = await win.key()
+        Like mouse, this handles the window's events every 10 milliseconds while waiting."""
+        return await self._next("key")
+
+    async def _next(self, kind):
+        import asyncio
+        if self._closed:
+            return None
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (kind, future)
+        self._waiters.append(waiter)
+        if self._pumpCall is None:
+            self._pumpCall = loop.call_soon(self._pump, loop)
+        try:
+            value = await future
+        finally:
+            self._waiters.remove(waiter)
+            if not self._waiters and self._pumpCall is not None:
+                self._pumpCall.cancel()
+                self._pumpCall = None
+        if value is not None:
+            self._consume(kind)
+        return value
+
+    def _pump(self, loop):
+        """Handle Tk events, and again in 10 milliseconds, while a coroutine is waiting"""
+        self._pumpCall = None
+        if self._waiters and not self._closed:
+            _getRoot().update()
+            if self._waiters and self._pumpCall is None:
+                self._pumpCall = loop.call_later(0.01, self._pump, loop)
+
     def setMouseHandler(self, func):
         self._mouseCallback = func
 
@@ -177,9 +884,16 @@ class ImageWin(tk.Canvas):
     def _onClick(self, e):
         self.mouseX = e.x
         self.mouseY = e.y
+        self._events.append(("click", e.x, e.y))
+        self._wake("click", (e.x, e.y))
         if self._mouseCallback:
             self._mouseCallback(e.x, e.y)
 
+    def _onKey(self, e):
+        self.lastKey = e.keysym
+        self._events.append(("key", e.keysym))
+        self._wake("key", e.keysym)
+
     def _on_click(self, e):
         self._onClick(e)
 
@@ -195,13 +909,30 @@ class ImageWin(tk.Canvas):
         self.exitOnClick()
 
 class Pixel(object):
-    """This simple class abstracts the RGB pixel values."""
-    def __init__(self, red, green, blue):
-        super(Pixel, self).__init__()
-        self.max = 255
+    """This simple class abstracts the RGB pixel values.  Pixels of RGBA images also have
+    an alpha value, from 0 (transparent) to 255 (opaque)."""
+    # toList makes one Pixel per pixel, so keep them small: no per-instance dict
+    __slots__ = ('__red', '__green', '__blue', '__alpha')
+    max = 255
+
+    def __init__(self, red, green, blue, alpha=None):
         self.setRed(red)
         self.setGreen(green)
         self.setBlue(blue)
+        if alpha is not None:
+            self.setAlpha(alpha)
+
+    @classmethod
+    def _fromTrusted(cls, red, green, blue, alpha=None):
+        """Make a pixel without checking the values.  Only for values that are already
+        known to be integers between 0 and 255, such as those read from an image."""
+        p = cls.__new__(cls)
+        p.__red = red
+        p.__green = green
+        p.__blue = blue
+        if alpha is not None:
+            p.__alpha = alpha
+        return p
 
     def getRed(self):
         """Return the red component of the pixel"""
@@ -224,6 +955,16 @@ class Pixel(object):
     def get_blue(self):
         return self.getBlue()
 
+    def getAlpha(self):
+        """Return the alpha (opacity) of the pixel, 255 unless it was set"""
+        try:
+            return int(self.__alpha)
+        except AttributeError:
+            return 255
+
+    def get_alpha(self):
+        return self.getAlpha()
+
     def getColorTuple(self):
         """Return all color information as a tuple"""
         return (int(self.__red), int(self.__green), int(self.__blue))
@@ -267,6 +1008,18 @@ class Pixel(object):
     def set_blue(self, blue):
         self.setBlue(blue)
 
+    def setAlpha(self, alpha):
+        """Modify the alpha (opacity), used by RGBA images"""
+        if not isinstance(alpha, int):
+            raise TypeError("Error:  pixel value %r is not an integer" % alpha)
+        elif self.max >= alpha >= 0:
+            self.__alpha = alpha
+        else:
+            raise ValueError("Error:  pixel value %d is out of range" % alpha)
+
+    def set_alpha(self, alpha):
+        self.setAlpha(alpha)
+
     def __getitem__(self,key):
         """Allow new style pixel class to act like a color tuple:
            0 --> red
@@ -293,7 +1046,7 @@ class Pixel(object):
             # formatPixel to work correctly. Was 1.0 ever used?
             self.max = 1.0
         elif pmax == 255:
-            self.max = 255
+            pass    # max is always 255
         else:
             raise ValueError("Error range must be 1.0 or 256")
 
@@ -310,6 +1063,11 @@ class Pixel(object):
     red = property(getRed, setRed, None, "I'm the red property.")
     green = property(getGreen, setGreen, None, "I'm the green property.")
     blue = property(getBlue, setBlue, None, "I'm the blue property.")
+    alpha = property(getAlpha, setAlpha, None, "I'm the alpha property.")
+
+def _leaveShare(sharers):
+    """Take one image off the count of images sharing some pixels"""
+    sharers[0] -= 1
 
 class AbstractImage(object):
     """
@@ -319,42 +1077,54 @@ class AbstractImage(object):
     3. From another image object
     4. By specifying the height and width to create a blank image.
     """
-    imageCache = {} # tk photoimages go here to avoid GC while drawn
+    imageCache = {} # tk photoimages go here to avoid GC while drawn, until undrawn
     imageId = 1
+    _delay = None   # seconds to wait after each animation frame, None when setDelay is off
+    previewSize = (800, 800)    # box that notebook previews of larger images are shrunk to fit
 
-    def __init__(self,fname=None,data=[],imobj=None,height=0,width=0):
+    def __init__(self,fname=None,data=[],imobj=None,height=0,width=0,array=None,maxSize=None,scale=None,
+                 mode="RGB"):
         """
         An image can be created using any of the following keyword parameters. When image creation is
-        complete the image will be an rgb image.
+        complete the image will be an rgb image, unless another mode is given.
         fname:  A filename containing an image.  Can be jpg, gif, and others
         data:  a list of lists representing the image.  This might be something you construct by
         reading an asii format ppm file, or an ascii art file and translate into rgb yourself.
         imobj:  Make a copy of another image.
         height:
         width: Create a blank image of a particular height and width.
+        array:  Use the memory of a height x width x 3 array of bytes (a numpy uint8 array for
+        example) for the pixels, without copying it.
+        maxSize:  With fname, shrink the image to fit in a (width, height) box as it is loaded.
+        scale:  With fname, shrink the image by this factor (between 0 and 1) as it is loaded.
+        mode:  "RGB", "L" for grayscale (one byte per pixel instead of three) or "RGBA" for
+        colors with an alpha (opacity) value.  Images from another image or an array take
+        their mode from it.
         """
         super(AbstractImage, self).__init__()
-
-        # if PIL is available then use the PIL functions otherwise fall back to Tk
-        if pilAvailable:
-            self.loadImage = self.loadPILImage
-            self.createBlankImage = self.createBlankPILImage
-            self.setPixel = self.setPILPixel
-            self.set_pixel = self.setPILPixel
-            self.getPixel = self.getPILPixel
-            self.get_pixel = self.getPILPixel
-            self.save = self.savePIL
+        self.mode = mode
+        self._bands = _checkMode(mode)
+        self._external = False
+        self._pending = None    # file name of an image whose pixels have not been read yet
+        self._sharers = None    # [number of images sharing im], see copy
+        self._leave = None      # gives this image's share back, when it changes or dies
+        self._stats = None      # statistics and previews of the pixels by name, see _cachedStat
+        self._fileKey = None    # where to put the pixels in the file cache once decoded
+
+        # if PIL is available then use the PIL functions otherwise keep the pixels in memory
+        # and only use Tk to read gif files and draw.  Images made from an array always keep
+        # their pixels in the array's memory.
+        if isinstance(imobj, AbstractImage):
+            self._bindBackend(imobj._backend)
+        elif array is not None or not pilAvailable:
+            self._bindBackend("Buffer")
         else:
-            self.loadImage = self.loadTkImage
-            self.createBlankImage = self.createBlankTkImage
-            self.setPixel = self.setTkPixel
-            self.set_pixel = self.setTkPixel
-            self.getPixel = self.getTkPixel
-            self.get_pixel = self.getTkPixel
-            self.save = self.saveTk
-
-        if fname:
-            self.loadImage(fname)
+            self._bindBackend("PIL")
+
+        if array is not None:
+            self._wrapArray(array)
+        elif fname:
+            self.loadImage(fname, maxSize, scale)
             self.imFileName = fname
         elif data:
             height = len(data)
@@ -365,33 +1135,182 @@ class AbstractImage(object):
                     self.setPixel(col,row,Pixel(data[row][col]))
         elif height > 0 and width > 0:
             self.createBlankImage(height,width)
+        elif isinstance(imobj, AbstractImage):
+            self._shareWith(imobj)
         elif imobj:
+            if imobj.mode not in _modeBands:
+                imobj = imobj.convert("RGB")
+            self.mode = imobj.mode
+            self._bands = _modeBands[imobj.mode]
             self.im = imobj.copy()
-
-        if pilAvailable:
             self.width,self.height = self.im.size
-        else:
-            self.width = self.im.width()
-            self.height = self.im.height()
+
         self.centerX = self.width/2+3     # +3 accounts for the ~3 pixel border in Tk windows
         self.centerY = self.height/2+3
         self.id = None
-
-    def setDelay(self, delay=0, interval=0):
-        """Just a stub so that programs copy/pasted from an online textbook do not crash."""
-        print("The setDelay function is not implemented in this version of the image module. " \
-              "To animate your code, put img.draw(win) inside your nested loop, indented the " \
-              "same amount as the inner loop.")
-
-    def set_delay(self, delay=0, interval=0):
-        self.setDelay(delay, interval)
-
-    def loadPILImage(self,fname):
-        self.im = PIL_Image.open(fname)
-        ni = self.im.convert("RGB")
-        self.im = ni
-
-    def loadTkImage(self,fname):
+        self._cacheId = None    # key of this image's photo in imageCache once drawn
+        self._items = {}        # canvas item showing this image, for each window it is drawn in
+        self._dirty = None      # [left, top, right, bottom] box changed since the last draw
+
+    def _getIm(self):
+        if self._pending is not None:
+            self._decode()
+        return self._im
+
+    def _setIm(self, im):
+        if self._sharers is not None:
+            # new pixels, so stop sharing the old ones
+            self._leave()
+            self._leave = None
+            self._sharers = None
+        self._im = im
+        self._stats = None
+
+    # the PIL image or rgb bytes holding the pixels, read from the file when first used
+    im = property(_getIm, _setIm)
+
+    def _decode(self):
+        """Read the pixels of an image file whose header was read by loadImage"""
+        if self._backend == "PIL":
+            self._im = self._decodePILImage(self._pending)
+        else:
+            self._im = self._decodeTkImage(self._pending)
+        self._pending = None
+        if self._fileKey is not None:
+            _storeCached(self)
+
+    def _beforeWrite(self, x, y, w=1, h=1):
+        """Get ready to change the pixels of the w by h region at x,y: make a private copy
+        of pixels shared with copies of this image, and record the region as changed since
+        the image was last drawn.  Statistics of the old pixels are forgotten."""
+        if self._external and isinstance(self._im, memoryview) and self._im.readonly:
+            raise TypeError("Error: the pixels of this image are read-only; to change a "
+                            "MappedImage, open it with writable=True")
+        if self._pending is not None:
+            self._decode()      # decoding can share the pixels with the file cache
+        self._stats = None
+        if self._sharers is not None and self._sharers[0] > 1:
+            if self._backend == "PIL":
+                self.im = self._im.copy()
+            else:
+                self.im = bytearray(self._im)
+                self._external = False
+        d = self._dirty
+        if d is None:
+            self._dirty = [x, y, x + w, y + h]
+        else:
+            if x < d[0]:
+                d[0] = x
+            if y < d[1]:
+                d[1] = y
+            if x + w > d[2]:
+                d[2] = x + w
+            if y + h > d[3]:
+                d[3] = y + h
+
+    def _bindBackend(self, backend):
+        """Point the public pixel and loading methods at the functions for one backend:
+        PIL (a PIL image) or Buffer (rgb bytes in memory, read and written with Tk
+        when there is no PIL)."""
+        self._backend = backend
+        _liveImages.add(self)   # so a profile can rebind them
+        if backend == "PIL":
+            self.loadImage = self.loadPILImage
+            self.createBlankImage = self.createBlankPILImage
+            self.setPixel = self.setPILPixel
+            self.getPixel = self.getPILPixel
+            self.getPixels = self.getPILPixels
+            self.setPixels = self.setPILPixels
+        else:
+            self.loadImage = self.loadTkImage
+            self.createBlankImage = self.createBlankTkImage
+            self.setPixel = self.setBufferPixel
+            self.getPixel = self.getBufferPixel
+            self.getPixels = self.getBufferPixels
+            self.setPixels = self.setBufferPixels
+        self.set_pixel = self.setPixel
+        self.get_pixel = self.getPixel
+        self.get_pixels = self.getPixels
+        self.set_pixels = self.setPixels
+        if self._delay is not None and self._items:
+            self._bindAnimation()
+
+    def setDelay(self, delay=0, interval=0, fps=None):
+        """Animate the changes made to the image: once it is drawn, every setPixel counts
+        towards the next frame, and after interval of them the image is redrawn in its
+        windows and the program waits delay milliseconds.  With fps, frames are also
+        kept to at most that many per second.  So a loop of setPixel calls plays as an
+        animation without calling draw inside the loop.  setDelay(None) turns this off."""
+        if delay is None:
+            self._delay = None
+            self._bindBackend(self._backend)
+            return
+        for name, value in (("delay", delay), ("interval", interval), ("fps", fps)):
+            if value is not None and not isinstance(value, (int, float)):
+                raise TypeError("Error: %s %r is not a number" % (name, value))
+        for name, value in (("delay", delay), ("interval", interval)):
+            if value < 0:
+                raise ValueError("Error: %s %r is not 0 or more" % (name, value))
+        if fps is not None and fps <= 0:
+            raise ValueError("Error: fps %r is not positive" % (fps,))
+        self._delay = delay / 1000
+        self._interval = max(interval, 1)
+        self._frameTime = 1 / fps if fps else 0
+        self._writes = 0
+        self._lastFrame = 0
+        if self._items:
+            self._bindAnimation()
+
+    def set_delay(self, delay=0, interval=0, fps=None):
+        self.setDelay(delay, interval, fps)
+
+    def _bindAnimation(self):
+        """Point setPixel at _animatedSetPixel, which counts the writes towards a frame.
+        Only done while setDelay is on and the image is drawn."""
+        if self._backend == "PIL":
+            self._setPixelNow = self.setPILPixel
+        else:
+            self._setPixelNow = self.setBufferPixel
+        self.setPixel = self._animatedSetPixel
+        self.set_pixel = self.setPixel
+
+    def _animatedSetPixel(self, x, y, pixel):
+        self._setPixelNow(x, y, pixel)
+        self._writes += 1
+        if self._writes >= self._interval:
+            if self._frameTime:
+                if time.perf_counter() - self._lastFrame < self._frameTime:
+                    return
+            self._frame()
+
+    def _frame(self):
+        """Redraw the image in every window it is in, then wait for the delay"""
+        for win in list(self._items):
+            self.draw(win)
+        self._writes = 0
+        if self._delay:
+            time.sleep(self._delay)
+        self._lastFrame = time.perf_counter()
+
+    def loadPILImage(self,fname,maxSize=None,scale=None):
+        # only the header is read now, the pixels are decoded when they are first used
+        if _loadCached(self, fname, maxSize, scale):
+            return
+        with PIL_Image.open(fname) as im:
+            self.width, self.height = _fitSize(im.size, maxSize, scale)
+        self._pending = fname
+
+    def _decodePILImage(self, fname):
+        size = (self.width, self.height)
+        with PIL_Image.open(fname) as im:
+            if im.size != size:
+                im.draft(self.mode, size)   # jpeg files can be decoded at 1/2, 1/4 or 1/8 size
+            ni = im.convert(self.mode)
+        if ni.size != size:
+            ni = ni.resize(size, PIL_Image.LANCZOS)
+        return ni
+
+    def loadTkImage(self,fname,maxSize=None,scale=None):
         sufstart = fname.rfind('.')
         if sufstart < 0:
             suffix = ""
@@ -399,29 +1318,80 @@ class AbstractImage(object):
             suffix = fname[sufstart:]
         if suffix not in ['.gif', '.ppm']:
             raise ValueError("Bad Image Type: %s : Without PIL, only .gif or .ppm files are allowed" % suffix)
-        self.im = tkinter.PhotoImage(file=fname)
+        if _loadCached(self, fname, maxSize, scale):
+            return
+        if suffix == '.ppm':
+            # only the header is read now, the pixels are read when they are first used
+            with open(fname, 'rb') as f:
+                size = _readPPMHeader(f)[:2]
+            self.width, self.height = _fitSize(size, maxSize, scale)
+            self._pending = fname
+        else:
+            root = _getRoot()
+            photo = tkinter.PhotoImage(file=fname, master=root)
+            size = (photo.width(), photo.height())
+            self.width, self.height = _fitSize(size, maxSize, scale)
+            data = _resizeNearest(_photoPixels(photo, 0, 0, size[0], size[1]), size,
+                                  (self.width, self.height))
+            self.im = _convertData(data, 3, self._bands)
+            if self._fileKey is not None:
+                _storeCached(self)
+
+    def _decodeTkImage(self, fname):
+        with open(fname, 'rb') as f:
+            width, height, bands = _readPPMHeader(f)
+            data = _readPPMPixels(f, width, height, bands)
+        data = _resizeNearest(data, (width, height), (self.width, self.height), bands)
+        return _convertData(data, bands, self._bands)
 
     def createBlankPILImage(self,height,width):
-        self.im = PIL_Image.new("RGB",(width,height), (255, 255, 255))
-        ni = self.im.convert("RGB")
-        self.im = ni
+        self.width = width
+        self.height = height
+        self.im = PIL_Image.new(self.mode,(width,height), "white")
 
     def createBlankTkImage(self,height,width):
-        self.im = tkinter.PhotoImage(height=height,width=width)
-        hexcode = "#%02x%02x%02x" % (255,255,255)
-        horizontal_line = "{" + " ".join([hexcode]*width) + "}"
-        self.im.put(" ".join([horizontal_line]*height))
+        self.width = width
+        self.height = height
+        self.im = bytearray(b"\xff") * (width * height * self._bands)
 
     def copy(self):
-        """Return a copy of this image"""
-        newI = AbstractImage(imobj=self.im)
+        """Return a copy of this image, of the same class and with the same file name.
+        Copying is quick: the copy shares its pixels with this image until one of them
+        is changed."""
+        newI = self.__class__.__new__(self.__class__)
+        AbstractImage.__init__(newI, imobj=self)
         return newI
 
+    def _shareWith(self, other):
+        """Use the pixels of the image other, copy-on-write"""
+        self.width = other.width
+        self.height = other.height
+        self.mode = other.mode
+        self._bands = other._bands
+        if hasattr(other, "imFileName"):
+            self.imFileName = other.imFileName
+        if other._external:
+            # the pixels can change behind the image's back, so they can not be shared
+            self.im = bytearray(other.im)
+            return
+        if other._sharers is None:
+            other._joinShare([0])
+        self._im = other.im
+        self._joinShare(other._sharers)
+        if other._stats is None:
+            other._stats = {}
+        self._stats = other._stats  # same pixels, same statistics, until one is changed
+
+    def _joinShare(self, sharers):
+        """Count this image as one of the images sharing pixels with the counter sharers,
+        until it gets new pixels or is garbage collected"""
+        sharers[0] += 1
+        self._sharers = sharers
+        self._leave = weakref.finalize(self, _leaveShare, sharers)
 
     def clone(self):
          """Return a copy of this image"""
-         newI = AbstractImage(imobj=self.im)
-         return newI
+         return self.copy()
 
     def getHeight(self):
         """Return the height of the image"""
@@ -437,36 +1407,634 @@ class AbstractImage(object):
     def get_width(self):
         return self.width
 
-    def getTkPixel(self,x,y):
-        """Get a pixel at the given x,y coordinate.  The pixel is returned as an rgb color tuple
-        for example foo.getPixel(10,10) --> (10,200,156) """
-        p = self.im.get(x,y)
-        # p is a string in some tkinter versions; tuple in others.
-        try:
-            p = [int(j) for j in p.split()]
-        except AttributeError:
-            pass
-        return Pixel(p[0],p[1],p[2])
-
-    def setTkPixel(self,x,y,pixel):
-        """Set the color of a pixel at position x,y.  The color must be specified as an rgb tuple (r,g,b) where
-        the rgb values are between 0 and 255."""
-        if x < self.getWidth() and y < self.getHeight():
-            self.im.put(formatPixel(pixel.getColorTuple()),(x,y))
-        else:
-            raise ValueError("Pixel index out of range.")
-
     def getPILPixel(self,x,y):
         """docstring for getPILPIxel"""
         p = self.im.getpixel((x,y))
-        return Pixel(p[0],p[1],p[2])
+        if self._bands == 3:
+            return Pixel._fromTrusted(p[0],p[1],p[2])
+        elif self._bands == 1:
+            return Pixel._fromTrusted(p,p,p)
+        return Pixel._fromTrusted(p[0],p[1],p[2],p[3])
 
     def setPILPixel(self,x,y,pixel):
         """docstring for setPILPixel"""
         if x < self.getWidth() and y < self.getHeight():
-            self.im.putpixel((x,y),pixel.getColorTuple())
+            self._beforeWrite(x % self.width, y % self.height)   # PIL allows negative indices
+            if self._bands == 3:
+                self.im.putpixel((x,y),pixel.getColorTuple())
+            else:
+                self.im.putpixel((x,y),_pixelValues(pixel, self._bands))
+        else:
+            raise ValueError("Pixel index out of range")
+
+    def _checkRegion(self, x, y, w, h):
+        """Fill in a default region (the whole image) and make sure it lies inside the image.
+        Returns the region as a tuple (x, y, w, h)."""
+        if w is None:
+            w = self.width - x
+        if h is None:
+            h = self.height - y
+        for name, value in (("x", x), ("y", y), ("width", w), ("height", h)):
+            if not isinstance(value, int):
+                raise TypeError("Error: region %s %r is not an integer" % (name, value))
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > self.width or y + h > self.height:
+            raise ValueError("Error: region (%d, %d, %d, %d) is not inside the %dx%d image"
+                             % (x, y, w, h, self.width, self.height))
+        return x, y, w, h
+
+    def _checkRegionData(self, w, h, data):
+        """Make sure data holds exactly the pixel bytes of a w by h region and return it
+        as a memoryview of bytes."""
+        data = memoryview(data).cast("B")
+        if len(data) != w * h * self._bands:
+            raise ValueError("Error: %d bytes of data do not match a %dx%d %s region (%d bytes needed)"
+                             % (len(data), w, h, self.mode, w * h * self._bands))
+        return data
+
+    def getPILPixels(self, x=0, y=0, w=None, h=None):
+        """Return the pixels of the w by h region whose top left corner is at x,y as a
+        bytearray.  The pixels are listed row by row, three bytes (r, g, b) per pixel,
+        or one (gray) for L images and four (r, g, b, alpha) for RGBA images.
+        With no arguments the whole image is returned."""
+        x, y, w, h = self._checkRegion(x, y, w, h)
+        if (x, y, w, h) == (0, 0, self.width, self.height):
+            return bytearray(self.im.tobytes())
+        return bytearray(self.im.crop((x, y, x + w, y + h)).tobytes())
+
+    def setPILPixels(self, x, y, w, h, data):
+        """Replace the pixels of the w by h region whose top left corner is at x,y.  data
+        is any bytes-like object laid out the way getPixels returns it."""
+        x, y, w, h = self._checkRegion(x, y, w, h)
+        data = self._checkRegionData(w, h, data)
+        self._beforeWrite(x, y, w, h)
+        self.im.paste(PIL_Image.frombytes(self.mode, (w, h), data), (x, y))
+
+    def _wrapArray(self, array):
+        """Use the memory of a height x width x 3 array of bytes for the pixels, or
+        height x width for an L image and height x width x 4 for an RGBA image."""
+        view = memoryview(array)
+        if view.format not in ("B", "<B", ">B", "=B"):
+            raise TypeError("Error: array elements must be unsigned bytes (numpy uint8), not %r"
+                            % view.format)
+        if view.ndim == 2:
+            bands = 1
+        elif view.ndim == 3 and view.shape[2] in (3, 4):
+            bands = view.shape[2]
         else:
+            bands = None
+        if bands is None or view.shape[0] == 0 or view.shape[1] == 0:
+            raise ValueError("Error: array shape %r is not height x width, height x width x 3 "
+                             "or height x width x 4" % (view.shape,))
+        if not view.c_contiguous:
+            # a copy would not share the array's memory, so changes would not reach it
+            raise ValueError("Error: the array's rows and pixels must follow each other in "
+                             "memory (C-contiguous); pass a copy such as "
+                             "numpy.ascontiguousarray(array)")
+        self.height, self.width = view.shape[0], view.shape[1]
+        self._bands = bands
+        self.mode = {1: "L", 3: "RGB", 4: "RGBA"}[bands]
+        self.im = view.cast("B")
+        # the array can be changed without the image knowing, so draw always copies all of it
+        self._external = True
+
+    def _arrayShape(self):
+        """Return the shape of the array holding the pixels, see toArray"""
+        if self._bands == 1:
+            return (self.height, self.width)
+        return (self.height, self.width, self._bands)
+
+    def _shapedView(self, data):
+        """Return flat pixel bytes shaped as a memoryview with the shape of toArray."""
+        return memoryview(data).cast("B", self._arrayShape())
+
+    def getBufferPixel(self, x, y):
+        """Return the Pixel at x,y of an image kept in memory"""
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise ValueError("Pixel index out of range")
+        bands = self._bands
+        i = (y * self.width + x) * bands
+        buf = self.im
+        if bands == 3:
+            return Pixel._fromTrusted(buf[i], buf[i + 1], buf[i + 2])
+        elif bands == 1:
+            return Pixel._fromTrusted(buf[i], buf[i], buf[i])
+        return Pixel._fromTrusted(buf[i], buf[i + 1], buf[i + 2], buf[i + 3])
+
+    def setBufferPixel(self, x, y, pixel):
+        """Set the Pixel at x,y of an image kept in memory"""
+        if not (0 <= x < self.width and 0 <= y < self.height):
             raise ValueError("Pixel index out of range")
+        bands = self._bands
+        i = (y * self.width + x) * bands
+        self._beforeWrite(x, y)
+        if bands == 3:
+            self.im[i:i + 3] = bytes(pixel.getColorTuple())
+        elif bands == 1:
+            self.im[i] = _pixelValues(pixel, 1)
+        else:
+            self.im[i:i + 4] = bytes(_pixelValues(pixel, 4))
+
+    def getBufferPixels(self, x=0, y=0, w=None, h=None):
+        """Return the pixels of a region as a bytearray, see getPILPixels"""
+        x, y, w, h = self._checkRegion(x, y, w, h)
+        bands = self._bands
+        rowbytes = self.width * bands
+        if w == self.width:
+            return bytearray(self.im[y * rowbytes:(y + h) * rowbytes])
+        res = bytearray()
+        for row in range(y, y + h):
+            start = row * rowbytes + x * bands
+            res += self.im[start:start + w * bands]
+        return res
+
+    def setBufferPixels(self, x, y, w, h, data):
+        """Replace the pixels of a region, see setPILPixels"""
+        x, y, w, h = self._checkRegion(x, y, w, h)
+        data = self._checkRegionData(w, h, data)
+        self._beforeWrite(x, y, w, h)
+        bands = self._bands
+        rowbytes = self.width * bands
+        if w == self.width:
+            self.im[y * rowbytes:(y + h) * rowbytes] = data
+        else:
+            for i in range(h):
+                start = (y + i) * rowbytes + x * bands
+                self.im[start:start + w * bands] = data[i * w * bands:(i + 1) * w * bands]
+
+    # the names used before images without PIL were kept in memory
+    getTkPixel = getBufferPixel
+    setTkPixel = setBufferPixel
+    getTkPixels = getBufferPixels
+    setTkPixels = setBufferPixels
+
+    def toArray(self):
+        """Return the pixels as a height x width x 3 numpy array of uint8 (height x width for
+        L images, height x width x 4 for RGBA images).  For an ArrayImage,
+        or any image when PIL is not available, the array shares memory with the image, so
+        changing one changes the other.  Other images return a copy."""
+        import numpy
+        if self._backend == "Buffer":
+            if not self._external:
+                self._beforeWrite(0, 0, self.width, self.height)   # stop sharing with copies
+            self._external = True   # the array can now change the pixels
+            data = self.im
+        else:
+            data = self.getPixels()
+        return numpy.frombuffer(data, dtype=numpy.uint8).reshape(self._arrayShape())
+
+    def to_array(self):
+        return self.toArray()
+
+    def mapChannels(self, fred, fgreen=None, fblue=None):
+        """Change every pixel of the image by applying fred to its red value, fgreen to its
+        green value and fblue to its blue value.  Each function takes and returns an integer
+        between 0 and 255.  With only fred, it is applied to all three colors.  Each function
+        is called just 256 times, once for every possible value, so this is much faster than
+        a loop over the pixels.  For example, the negative of an image:
+            img.mapChannels(lambda v: 255 - v)
+        L images only have one value per pixel, which fred is applied to.  The alpha of
+        RGBA images is left as it is."""
+        if fgreen is None and fblue is None:
+            fgreen = fblue = fred
+        elif fgreen is None or fblue is None:
+            raise TypeError("Error: give one function for all colors or one for each color")
+        made = {}
+        tables = []
+        for f in (fred, fgreen, fblue)[:self._bands]:
+            if f not in made:
+                made[f] = _channelTable(f)
+            tables.append(made[f])
+        if self._bands == 4:
+            tables.append(bytes(range(256)))
+
+        self._beforeWrite(0, 0, self.width, self.height)
+        if self._backend == "PIL":
+            self.im = self.im.point(list(b"".join(tables)))
+        else:
+            _translateChannels(self.im, tables)
+
+    def map_channels(self, fred, fgreen=None, fblue=None):
+        self.mapChannels(fred, fgreen, fblue)
+
+    def mapPixels(self, func):
+        """Return a new image made by calling func on every pixel of this one.  func takes
+        a Pixel and returns a Pixel."""
+        data = self.getPixels()
+        _mapPixelData(func, data, data, 0, len(data), self._bands)
+        return self._newImage(self.width, self.height, data)
+
+    def map_pixels(self, func):
+        return self.mapPixels(func)
+
+    def parallelMap(self, func, workers=None, minPixels=100000):
+        """Return a new image made by calling func on every pixel of this one, like
+        mapPixels, but with the rows split into bands that are worked on by workers
+        processes at once (by default, one per CPU).  Images with fewer than minPixels
+        pixels are done in this process, since starting the workers would take longer.
+        func is sent to the workers by name, so it must be defined at the top level of
+        a module, and on Windows and macOS the program must start work under an
+        if __name__ == '__main__': test."""
+        import multiprocessing
+        from multiprocessing import shared_memory
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1 or self.width * self.height < minPixels:
+            return self.mapPixels(func)
+
+        rowbytes = self.width * self._bands
+        size = rowbytes * self.height
+        source = shared_memory.SharedMemory(create=True, size=size)
+        result = shared_memory.SharedMemory(create=True, size=size)
+        try:
+            source.buf[:size] = self.getPixels()
+            # a few bands per worker, so a slow band does not hold up the rest
+            rows = -(-self.height // (workers * 4))
+            bands = [(func, source.name, result.name, rowbytes, top, min(top + rows, self.height),
+                      self._bands)
+                     for top in range(0, self.height, rows)]
+            with multiprocessing.Pool(workers) as pool:
+                pool.map(_mapBand, bands)
+            newI = self._newImage(self.width, self.height, result.buf[:size])
+        finally:
+            source.close()
+            source.unlink()
+            result.close()
+            result.unlink()
+        return newI
+
+    def parallel_map(self, func, workers=None, minPixels=100000):
+        return self.parallelMap(func, workers, minPixels)
+
+    def _newImage(self, width, height, pixels):
+        """Return a new EmptyImage of the given size holding pixels: a PIL image, or pixel
+        bytes in the mode of this image"""
+        if pilAvailable and isinstance(pixels, PIL_Image.Image):
+            newI = EmptyImage(width, height, pixels.mode)
+        else:
+            newI = EmptyImage(width, height, self.mode)
+        if newI._backend == "Buffer" and isinstance(pixels, bytearray):
+            newI.im = pixels
+        elif pilAvailable and isinstance(pixels, PIL_Image.Image):
+            if newI._backend == "PIL":
+                newI.im = pixels
+            else:
+                newI.im = bytearray(pixels.tobytes())
+        else:
+            newI.setPixels(0, 0, width, height, pixels)
+        return newI
+
+    def convolve(self, kernel, scale=None, offset=0):
+        """Return a new image where each pixel is a weighted sum of the pixels around it.
+        kernel is a list of rows of weights with an odd number of rows and columns; the
+        center weight is for the pixel itself.  The sum is divided by scale (by default
+        the sum of the weights, or 1 if they add up to 0) and offset is added.  Pixels
+        beyond the edges of the image count as copies of the nearest edge pixel.  The alpha
+        of RGBA images is left as it is.
+        Kernels that are one row times one column, like blurs, are done as two quick
+        passes, one across and one down."""
+        kernel = _checkKernel(kernel)
+        if scale is None:
+            scale = sum(map(sum, kernel)) or 1
+        if scale == 0:
+            raise ValueError("Error: scale can not be 0")
+        if self._bands == 4:
+            return self._withAlpha(self.convert("RGB").convolve(kernel, scale, offset))
+        width, height = self.width, self.height
+        rows, cols = len(kernel), len(kernel[0])
+        if pilAvailable and rows == cols and rows in (3, 5):
+            from PIL import ImageFilter
+            im = self._pilImage()
+            # PIL leaves the border unchanged, so filter a copy with the edges repeated.
+            # PIL also takes the rows of the kernel bottom to top.
+            r = rows // 2
+            weights = [w for row in reversed(kernel) for w in row]
+            filtered = _padEdges(im, r).filter(ImageFilter.Kernel((cols, rows), weights, scale, offset))
+            return self._newImage(width, height, filtered.crop((r, r, r + width, r + height)))
+
+        data = self.getPixels()
+        numpy = _numpy()
+        if numpy is not None:
+            sums = _correlateArray(numpy, data, width, height, kernel, self._bands) / scale + offset
+            return self._newImage(width, height, _clampArray(numpy, sums))
+        res = bytearray()
+        for sums in _correlateRows(data, width, height, kernel, self._bands):
+            res += _clampRow([v / scale + offset for v in sums])
+        return self._newImage(width, height, res)
+
+    def _withAlpha(self, rgb):
+        """Return a new RGBA image with the colors of the RGB image rgb and the alpha of
+        this one, for filters that only change the colors"""
+        if pilAvailable:
+            im = rgb._pilImage().convert("RGBA")
+            im.putalpha(self._pilImage().getchannel("A"))
+            return self._newImage(self.width, self.height, im)
+        data = bytearray(_convertData(rgb.getPixels(), 3, 4))
+        data[3::4] = self.getPixels()[3::4]
+        return self._newImage(self.width, self.height, data)
+
+    def blur(self, radius=1):
+        """Return a blurred copy of the image: each pixel is the average of the square of
+        pixels radius pixels around it"""
+        _checkPositive("blur radius", radius)
+        size = 2 * radius + 1
+        return self.convolve([[1] * size] * size)
+
+    def sharpen(self):
+        """Return a sharpened copy of the image"""
+        return self.convolve([[0, -1, 0], [-1, 5, -1], [0, -1, 0]])
+
+    def sobel(self):
+        """Return the edges of the image found by the Sobel operator: each color value is
+        how quickly that color changes at the pixel, so edges are bright and flat areas dark"""
+        if self._bands == 4:
+            return self._withAlpha(self.convert("RGB").sobel())
+        across = [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]]
+        down = [[-1, -2, -1], [0, 0, 0], [1, 2, 1]]
+        width, height, bands = self.width, self.height, self._bands
+        data = self.getPixels()
+        numpy = _numpy()
+        if numpy is not None:
+            strength = numpy.hypot(_correlateArray(numpy, data, width, height, across, bands),
+                                   _correlateArray(numpy, data, width, height, down, bands))
+            return self._newImage(width, height, _clampArray(numpy, strength))
+        res = bytearray()
+        for gx, gy in zip(_correlateRows(data, width, height, across, bands),
+                          _correlateRows(data, width, height, down, bands)):
+            res += _clampRow([(x * x + y * y) ** 0.5 for x, y in zip(gx, gy)])
+        return self._newImage(width, height, res)
+
+    def _pilImage(self):
+        """Return the pixels as a PIL image, the image itself or a copy for images in memory"""
+        if self._backend == "PIL":
+            return self.im
+        return self._toPILImage()
+
+    def convert(self, mode):
+        """Return a copy of the image in another mode: "RGB", "L" (grayscale) or "RGBA".
+        Colors become gray by their brightness, gray becomes equal red, green and blue,
+        and alpha is dropped, or set to 255 (opaque) when added."""
+        bands = _checkMode(mode)
+        if self._backend == "PIL":
+            return self._newImage(self.width, self.height, self.im.convert(mode))
+        newI = EmptyImage(self.width, self.height, mode)
+        newI.im = bytearray(_convertData(self.im, self._bands, bands))
+        return newI
+
+    def resize(self, width, height, method="nearest"):
+        """Return a copy of the image stretched or shrunk to width by height pixels.
+        method "nearest" gives each new pixel the color of the old pixel nearest to it;
+        "bilinear" mixes the four nearest, which looks smoother but takes longer."""
+        _checkPositive("width", width)
+        _checkPositive("height", height)
+        if method not in ("nearest", "bilinear"):
+            raise ValueError('Error: resize method %r is not "nearest" or "bilinear"' % (method,))
+        if pilAvailable:
+            resample = PIL_Image.NEAREST if method == "nearest" else PIL_Image.BILINEAR
+            return self._newImage(width, height, self._pilImage().resize((width, height), resample))
+        resizeData = _resizeNearest if method == "nearest" else _resizeBilinear
+        return self._newImage(width, height, bytearray(resizeData(self.getPixels(),
+                                                                  (self.width, self.height),
+                                                                  (width, height), self._bands)))
+
+    def crop(self, x, y, width, height):
+        """Return a new image of the width by height pixels whose top left corner is at x,y"""
+        return self._newImage(width, height, self.getPixels(x, y, width, height))
+
+    def flipH(self):
+        """Return a mirror image of the image, its left and right sides swapped"""
+        if pilAvailable:
+            return self._newImage(self.width, self.height,
+                                  self._pilImage().transpose(PIL_Image.FLIP_LEFT_RIGHT))
+        bands = self._bands
+        return self._newImage(self.width, self.height,
+                              _reverseRows(_reversePixels(self.getPixels(), bands), self.width, bands))
+
+    def flip_h(self):
+        return self.flipH()
+
+    def flipV(self):
+        """Return the image flipped upside down, its top and bottom swapped"""
+        if pilAvailable:
+            return self._newImage(self.width, self.height,
+                                  self._pilImage().transpose(PIL_Image.FLIP_TOP_BOTTOM))
+        return self._newImage(self.width, self.height,
+                              _reverseRows(self.getPixels(), self.width, self._bands))
+
+    def flip_v(self):
+        return self.flipV()
+
+    def rotate90(self, times=1):
+        """Return the image turned a quarter turn counterclockwise, or times quarter
+        turns; a negative times turns it clockwise"""
+        if not isinstance(times, int):
+            raise TypeError("Error: times %r is not an integer" % (times,))
+        times = times % 4
+        width, height = self.width, self.height
+        if times % 2:
+            width, height = height, width
+        if pilAvailable:
+            if times == 0:
+                return self._newImage(width, height, self._pilImage().copy())
+            turn = (None, PIL_Image.ROTATE_90, PIL_Image.ROTATE_180, PIL_Image.ROTATE_270)[times]
+            return self._newImage(width, height, self._pilImage().transpose(turn))
+        data = self.getPixels()
+        bands = self._bands
+        if times == 1:
+            data = _reverseRows(_transpose(data, self.width, self.height, bands), width, bands)
+        elif times == 2:
+            data = _reversePixels(data, bands)
+        elif times == 3:
+            data = _reversePixels(_reverseRows(_transpose(data, self.width, self.height, bands),
+                                               width, bands), bands)
+        return self._newImage(width, height, data)
+
+    def _sameSize(self, other, mode=None):
+        """Check that other is an image of the same size as this one, and return it in mode
+        (by default the mode of this image)"""
+        if not isinstance(other, AbstractImage):
+            raise TypeError("Error: %r is not an image" % (other,))
+        if (other.width, other.height) != (self.width, self.height):
+            raise ValueError("Error: the images are %dx%d and %dx%d, not the same size"
+                             % (self.width, self.height, other.width, other.height))
+        mode = mode or self.mode
+        if other.mode != mode:
+            other = other.convert(mode)
+        return other
+
+    def _arithmetic(self, other, op, swapped=False):
+        """Return a new image with each value of this image and the same value of other,
+        an image or a number, combined by op ("add", "subtract" or "multiply").  With a
+        number, swapped puts the number first."""
+        if isinstance(other, (int, float)) and not isinstance(other, bool):
+            f = {"add": operator.add, "subtract": operator.sub, "multiply": operator.mul}[op]
+            if swapped:
+                table = _channelTable(lambda v: min(255, max(0, round(f(other, v)))))
+            else:
+                table = _channelTable(lambda v: min(255, max(0, round(f(v, other)))))
+            tables = [table] * min(self._bands, 3)
+            if self._bands == 4:
+                tables.append(bytes(range(256)))
+            if pilAvailable:
+                return self._newImage(self.width, self.height,
+                                      self._pilImage().point(list(b"".join(tables))))
+            data = bytearray(self.getPixels())
+            _translateChannels(data, tables)
+            return self._newImage(self.width, self.height, data)
+        if not isinstance(other, AbstractImage):
+            return NotImplemented
+        other = self._sameSize(other)
+        if pilAvailable:
+            from PIL import ImageChops
+            im = self._pilImage()
+            res = getattr(ImageChops, op)(im, other._pilImage())
+            if self._bands == 4:
+                res.putalpha(im.getchannel("A"))
+            return self._newImage(self.width, self.height, res)
+        data = self.getPixels()
+        res = _combineData(op, data, other.getPixels())
+        if self._bands == 4:
+            res[3::4] = data[3::4]
+        return self._newImage(self.width, self.height, res)
+
+    def __add__(self, other):
+        """img1 + img2 is a new image with the values of the two images added, and values
+        over 255 kept at 255.  A number can be added to every value instead (img + 50 makes
+        an image brighter).  Images of another mode are converted to the mode of the first,
+        and the alpha of RGBA images comes from the first image."""
+        return self._arithmetic(other, "add")
+
+    def __radd__(self, other):
+        return self._arithmetic(other, "add")
+
+    def __sub__(self, other):
+        """img1 - img2 is a new image with the values of img2 taken from those of img1, and
+        values under 0 kept at 0.  255 - img is the negative of img."""
+        return self._arithmetic(other, "subtract")
+
+    def __rsub__(self, other):
+        return self._arithmetic(other, "subtract", swapped=True)
+
+    def __mul__(self, other):
+        """img1 * img2 is a new image with the values of the two images multiplied and
+        divided by 255, so white leaves the other image as it is and black makes black.
+        img * 1.5 multiplies every value by 1.5, keeping them at most 255."""
+        return self._arithmetic(other, "multiply")
+
+    def __rmul__(self, other):
+        return self._arithmetic(other, "multiply")
+
+    def blend(self, other, alpha):
+        """Return a new image mixing this image with other, an image of the same size.
+        alpha 0 gives this image, 1 gives other and 0.5 an even mix of the two."""
+        if not isinstance(alpha, (int, float)) or isinstance(alpha, bool):
+            raise TypeError("Error: alpha %r is not a number" % (alpha,))
+        if not 0 <= alpha <= 1:
+            raise ValueError("Error: alpha %r is not between 0 and 1" % (alpha,))
+        other = self._sameSize(other)
+        if pilAvailable:
+            return self._newImage(self.width, self.height,
+                                  PIL_Image.blend(self._pilImage(), other._pilImage(), alpha))
+        return self._newImage(self.width, self.height,
+                              _blendData(self.getPixels(), other.getPixels(), alpha))
+
+    def composite(self, other, mask):
+        """Return a new image showing other where mask is white and this image where mask
+        is black, mixing the two where it is gray.  other and mask are images of the same
+        size as this one; mask is made grayscale if it is not."""
+        other = self._sameSize(other)
+        mask = self._sameSize(mask, "L")
+        if pilAvailable:
+            return self._newImage(self.width, self.height,
+                                  PIL_Image.composite(other._pilImage(), self._pilImage(),
+                                                      mask._pilImage()))
+        return self._newImage(self.width, self.height,
+                              _compositeData(self.getPixels(), other.getPixels(),
+                                             mask.getPixels(), self._bands))
+
+    def tiles(self, width=None, height=None):
+        """Go over the image a tile at a time, giving the position of each tile and a new
+        image holding a copy of its pixels:
+
+            for x, y, tile in img.tiles(256, 256):
+                ... look at or change tile ...
+
+        Changes made to a tile are copied back into the image when the loop moves on, and
+        the tile can not be used after that (keep a copy of it if needed).  Only one tile
+        is in memory at a time, so this works on MappedImages larger than memory.  By
+        default the tiles are bands of whole rows, about a million pixels each."""
+        if width is None:
+            width = self.width
+        _checkPositive("tile width", width)
+        if height is None:
+            height = max(1, (1 << 20) // width)
+        _checkPositive("tile height", height)
+        for y in range(0, self.height, height):
+            h = min(height, self.height - y)
+            for x in range(0, self.width, width):
+                w = min(width, self.width - x)
+                tile = self._newImage(w, h, self.getPixels(x, y, w, h))
+                tile._dirty = None
+                yield x, y, tile
+                # drawing a tile clears its changed box, so write drawn tiles back anyway
+                if tile._dirty is not None or tile._cacheId is not None:
+                    self.setPixels(x, y, w, h, tile.getPixels())
+                # images are only freed by the garbage collector (they hold methods bound to
+                # themselves), so let go of the pixels now to keep just one tile in memory
+                tile.im = None
+
+    def _cachedStat(self, name, compute):
+        """Return the statistic name of the pixels, calling compute to work it out the
+        first time.  It is remembered until the pixels change."""
+        if self._external:
+            return compute()    # the pixels can change without the image knowing
+        if self._stats is None:
+            self._stats = {}
+        if name not in self._stats:
+            self._stats[name] = compute()
+        return self._stats[name]
+
+    def _computeHistogram(self):
+        bands = self._bands
+        if self._backend == "PIL":
+            counts = self.im.histogram()
+            return tuple(tuple(counts[c * 256:(c + 1) * 256]) for c in range(bands))
+        data = self.im
+        numpy = _numpy()
+        if numpy is not None:
+            values = numpy.frombuffer(data, dtype=numpy.uint8)
+            return tuple(tuple(numpy.bincount(values[c::bands], minlength=256).tolist())
+                         for c in range(bands))
+        res = []
+        for c in range(bands):
+            counts = collections.Counter(bytes(data[c::bands]))
+            res.append(tuple(counts[v] for v in range(256)))
+        return tuple(res)
+
+    def histogram(self):
+        """Return how many pixels have each value of each color, as a tuple of three tuples
+        (red, green, blue) of 256 counts.  L images have just one tuple, and RGBA images
+        a fourth one for alpha; mean and extrema follow the same pattern.  histogram, mean
+        and extrema are remembered until the image changes, so asking again is quick."""
+        return self._cachedStat("histogram", self._computeHistogram)
+
+    def mean(self):
+        """Return the average (red, green, blue) of the pixels, as floats"""
+        def compute():
+            pixels = self.width * self.height
+            return tuple(sum(v * n for v, n in enumerate(counts)) / pixels
+                         for counts in self.histogram())
+        return self._cachedStat("mean", compute)
+
+    def extrema(self):
+        """Return the smallest and largest value of each color, as the tuple
+        ((red min, red max), (green min, green max), (blue min, blue max))"""
+        def compute():
+            res = []
+            for counts in self.histogram():
+                used = [v for v in range(256) if counts[v]]
+                res.append((used[0], used[-1]))
+            return tuple(res)
+        return self._cachedStat("extrema", compute)
 
     def setPosition(self,x,y):
         """Set the position in the window where the top left corner of the window should be."""
@@ -479,57 +2047,211 @@ class AbstractImage(object):
         self.setPosition(x, y)
 
     def getImage(self):
-        if pilAvailable:
-            return ImageTk.PhotoImage(self.im)
+        # the root first, so that without tkinter or in headless mode the error says why
+        root = _getRoot()
+        if self._backend == "Buffer":
+            if pilAvailable:
+                from PIL import ImageTk
+                return ImageTk.PhotoImage(self._toPILImage(), master=root)
+            photo = tkinter.PhotoImage(width=self.width, height=self.height, master=root)
+            _putRGB(photo, _convertData(self.im, self._bands, 3), self.width, self.height)
+            return photo
+        from PIL import ImageTk   # imports tkinter, so only do it when drawing
+        return ImageTk.PhotoImage(self.im, master=root)
+
+    def _toPILImage(self):
+        """Return a PIL copy of an image kept in memory"""
+        return PIL_Image.frombytes(self.mode, (self.width, self.height), self.im)
+
+    def _getPhoto(self):
+        """Return the photo image shown when this image is drawn, brought up to date.
+        The photo is made once and then updated in place on later draws."""
+        if self._cacheId is None:
+            self._cacheId = AbstractImage.imageId
+            AbstractImage.imageId = AbstractImage.imageId + 1
+        ig = self.imageCache.get(self._cacheId)
+        if self._external:
+            self._dirty = [0, 0, self.width, self.height]
+        if ig is None or ig.width() != self.width or ig.height() != self.height:
+            ig = self.getImage()
+        elif self._dirty is not None:
+            self._putRegion(ig, *self._dirty)
+        self._dirty = None
+        self.imageCache[self._cacheId] = ig # save a reference else Tk loses it...
+        return ig
+
+    def _putRegion(self, ig, left, top, right, bottom):
+        """Copy the pixels inside the box from the image to its photo ig"""
+        w = right - left
+        h = bottom - top
+        if w == self.width and h == self.height:
+            if self._backend == "PIL":
+                ig.paste(self.im)
+            elif pilAvailable:
+                ig.paste(self._toPILImage())
+            else:
+                _putRGB(ig, _convertData(self.im, self._bands, 3), w, h)
+        elif pilAvailable:
+            # ImageTk can only paste a whole photo, so make a photo of just the
+            # changed pixels and let Tk copy it into place
+            from PIL import ImageTk
+            if self._backend == "PIL":
+                region = self.im.crop((left, top, right, bottom))
+            else:
+                region = PIL_Image.frombytes(self.mode, (w, h), self.getPixels(left, top, w, h))
+            patch = ImageTk.PhotoImage(region, master=_getRoot())
+            # set, so transparent pixels of RGBA images replace what was there
+            _getRoot().tk.call(str(ig), "copy", str(patch), "-to", left, top,
+                               "-compositingrule", "set")
         else:
-            return self.im
+            region = _convertData(self.getPixels(left, top, w, h), self._bands, 3)
+            _putRGB(ig, region, w, h, left, top)
 
     def draw(self,win):
-        """Draw this image in the ImageWin window."""
-        ig = self.getImage()
-        self.imageCache[self.imageId] = ig # save a reference else Tk loses it...
-        AbstractImage.imageId = AbstractImage.imageId + 1
+        """Draw this image in the ImageWin window.  Drawing an image again in the same
+        window updates it in place."""
+        ig = self._getPhoto()
         self.canvas=win
-        self.id = self.canvas.create_image(self.centerX,self.centerY,image=ig)
-        _imroot.update()
-
-    def saveTk(self,fname=None,ftype='gif'):
-        if fname == None:
-            fname = self.imFileName
-        sufstart = fname.rfind('.')
-        if sufstart < 0:
-            suffix = ""
+        item = self._items.get(win)
+        if item is None:
+            item = self.canvas.create_image(self.centerX,self.centerY,image=ig)
+            self._items[win] = item
+            win._images[self._cacheId] = self
         else:
-            suffix = fname[sufstart:]
-        if suffix == "":
-            suffix = "."+ftype
-            fname = fname+suffix
-        if suffix not in ['.gif', '.ppm']:
-            raise ValueError("Without PIL, only .gif or .ppm files are allowed")
-        try:
-            self.im.write(fname,format=ftype)
-        except IOError as e:
-            print(e)
-            print("Error saving, Could Not open ", fname, " to write.")
-        except tkinter.TclError as tke:
-            print(tke)
-            print("gif files can only handle 256 distinct colors")
-
-    def savePIL(self,fname=None,ftype='jpg'):
-        if fname == None:
+            self.canvas.coords(item, self.centerX, self.centerY)
+            self.canvas.itemconfig(item, image=ig)
+        self.id = item
+        if self._delay is not None and self.setPixel != self._animatedSetPixel:
+            self._bindAnimation()
+        _getRoot().update()
+
+    def undraw(self, win=None):
+        """Remove this image from the ImageWin window, or from every window it is drawn in."""
+        if win is None:
+            wins = list(self._items)
+        else:
+            wins = [win]
+        for w in wins:
+            item = self._items.pop(w, None)
+            if item is not None:
+                w.delete(item)
+                del w._images[self._cacheId]
+        if not self._items:
+            self.imageCache.pop(self._cacheId, None)
+            if self._delay is not None:
+                self._bindBackend(self._backend)    # nothing to animate
+            self.id = None
+
+    def _fileName(self, fname, ftype):
+        """Return the name of the file to save to and the format to write: ftype, or else
+        the suffix of fname.  With neither, jpg (or gif or ppm without PIL) is used and
+        added to the name."""
+        if fname is None:
+            if not hasattr(self, "imFileName"):
+                raise ValueError("Error: give the name of the file to save the image to")
             fname = self.imFileName
-        sufstart = fname.rfind('.')
-        if sufstart < 0:
-            suffix = ""
+        fname = os.fspath(fname)
+        suffix = os.path.splitext(fname)[1][1:]
+        if ftype is None:
+            ftype = suffix or ("jpg" if pilAvailable else "ppm" if headlessOn else "gif")
+        if not suffix:
+            fname = fname + "." + ftype
+        return fname, ftype.lower().lstrip(".")
+
+    def _saveFile(self, f, ftype, options):
+        """Write the image to f, a file name or a binary file, as an ftype file.  options
+        are passed on to PIL.  Returns f."""
+        if pilAvailable:
+            im = self._pilImage()
+            format = PIL_Image.registered_extensions().get("." + ftype, ftype.upper())
+            if format not in PIL_Image.SAVE:
+                raise ValueError("Error: %s files can not be written" % ftype)
+            if im.mode == "RGBA" and format in ("JPEG", "PPM"):
+                im = im.convert("RGB")  # these formats have no alpha
+            im.save(f, format, **options)
+            return f
+        if ftype == "gif" and isinstance(f, str):
+            # gif files are written by Tk, which is missing in headless mode
+            photo = self.getImage()
+            try:
+                photo.write(f, format='gif')
+            except tkinter.TclError as e:
+                raise ValueError("Error: could not write %s (gif files can only have 256 "
+                                 "colors): %s" % (f, e))
+            return f
+        if ftype == "ppm":
+            if self._bands == 1:
+                data = b'P5\n%d %d\n255\n' % (self.width, self.height) + self.im
+            else:
+                data = (b'P6\n%d %d\n255\n' % (self.width, self.height)
+                        + _convertData(self.im, self._bands, 3))
+        elif ftype == "png":
+            data = _pngBytes(self.im, self.width, self.height, self._bands,
+                             options.get("compress_level", -1))
         else:
-            suffix = fname[sufstart:]
-        if suffix == "":
-            suffix = "."+ftype
-            fname = fname+suffix
+            raise ValueError("Error: without PIL, only .gif, .png or .ppm files can be written")
+        if isinstance(f, str):
+            with open(f, 'wb') as out:
+                out.write(data)
+        else:
+            f.write(data)
+        return f
+
+    def save(self, fname=None, ftype=None, quality=None, compress_level=None):
+        """Save the image to the file fname, by default the file it was loaded from.  The
+        type of file is ftype ("png", "jpg", ...), or else the suffix of fname.  quality
+        (1 to 95) trades how good a jpg looks against its size, and compress_level (0 to 9)
+        how long a png takes to write against its size.  Without PIL only .gif, .png and
+        .ppm files can be written, and L images are written to .ppm files as pgm
+        (grayscale) data.  Errors, such as a file that can not be written, are raised."""
+        fname, ftype = self._fileName(fname, ftype)
+        self._saveFile(fname, ftype, _saveOptions(quality, compress_level))
+
+    savePIL = saveBuffer = saveTk = save
+
+    def saveAsync(self, fname=None, ftype=None, quality=None, compress_level=None):
+        """Start saving the image, like save, in a background thread and return a
+        concurrent.futures.Future.  Its result is the name of the file written, or it
+        raises the error that stopped the save.  The image is copied first (see copy), so
+        it can be changed straight away.  When several saves are already waiting,
+        saveAsync waits for one of them to finish."""
+        from concurrent.futures import Future
+        fname, ftype = self._fileName(fname, ftype)
+        options = _saveOptions(quality, compress_level)
+        snapshot = self.copy()
+        if not pilAvailable and ftype == "gif":
+            # Tk can only be used from the main thread, so save now
+            future = Future()
+            try:
+                future.set_result(snapshot._saveFile(fname, ftype, options))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        pool, slots = _saveExecutor()
+        slots.acquire()
         try:
-            self.im.save(fname)
-        except:
-            print("Error saving, Could Not open ", fname, " to write.")
+            future = pool.submit(snapshot._saveFile, fname, ftype, options)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda done: slots.release())
+        return future
+
+    def save_async(self, fname=None, ftype=None, quality=None, compress_level=None):
+        return self.saveAsync(fname, ftype, quality, compress_level)
+
+    def toBytes(self, format="png", **options):
+        """Return the contents of a file of the given format ("png", "jpg", ...) holding
+        the image, to keep in memory or send somewhere without writing a file.  options
+        are passed to PIL, for example quality=90 for jpg or compress_level=1 for a png
+        that is quick to make.  Without PIL only png and ppm can be made."""
+        import io
+        f = io.BytesIO()
+        self._saveFile(f, format.lower().lstrip("."), options)
+        return f.getvalue()
+
+    def to_bytes(self, format="png", **options):
+        return self.toBytes(format, **options)
 
 
     def toList(self):
@@ -548,23 +2270,129 @@ class AbstractImage(object):
 
     def __repr__(self):
         r = super(AbstractImage, self).__repr__()
-        if autoShowOn:
-            w = ImageWin(r, self.width, self.height)
-            self.draw(w)
+        if autoShowOn and not headlessOn:
+            if self._items:
+                for win in list(self._items):
+                    self.draw(win)  # only copies the pixels changed since it was shown
+            else:
+                self.draw(ImageWin(self.width, self.height, r))
         return r
 
+    def _previewDimensions(self):
+        return _fitSize((self.width, self.height), self.previewSize)
+
+    def _encodePreview(self):
+        width, height = self._previewDimensions()
+        if pilAvailable:
+            import io
+            im = self._pilImage()
+            if (width, height) != im.size:
+                im = im.resize((width, height), PIL_Image.BILINEAR)
+            f = io.BytesIO()
+            im.save(f, "PNG")
+            return f.getvalue()
+        data = self.getPixels()
+        if (width, height) != (self.width, self.height):
+            data = _resizeNearest(data, (self.width, self.height), (width, height), self._bands)
+        return _pngBytes(data, width, height, self._bands)
+
+    def _repr_png_(self):
+        """Return the image as png bytes, which notebooks such as Jupyter show instead of
+        opening a window.  Images larger than previewSize are shrunk to fit in it.  The
+        bytes are remembered until the image changes, so showing it again is quick."""
+        return self._cachedStat("png %dx%d" % self._previewDimensions(), self._encodePreview)
+
+    def _repr_html_(self):
+        """Return an html img tag showing the image (see _repr_png_)"""
+        import base64
+        return '<img src="data:image/png;base64,%s" width="%d" height="%d" alt="%dx%d %s image">' % (
+            (base64.b64encode(self._repr_png_()).decode("ascii"),) + self._previewDimensions()
+            + (self.width, self.height, self.mode))
+
 
 class FileImage(AbstractImage):
-    def __init__(self,thefile):
+    def __init__(self,thefile,maxSize=None,scale=None,mode="RGB"):
+        """Load an image file.  Only the size is read at first, the pixels are read when
+        they are first used.  To work on a smaller version of a large image, give maxSize,
+        a (width, height) box to shrink it into, or scale, a factor between 0 and 1.
+        jpeg files are then decoded at reduced size, which is much faster.  mode "L" loads
+        the image as grayscale and "RGBA" keeps its transparency."""
         if not isinstance(thefile, str):
             raise TypeError("Error: file name %r not a string" % thefile)
-        super(FileImage, self).__init__(fname = thefile)
+        super(FileImage, self).__init__(fname = thefile, maxSize = maxSize, scale = scale, mode = mode)
 
 class Image(FileImage):
         pass
 
+class ArrayImage(AbstractImage):
+    def __init__(self, array):
+        """Make an image that uses the memory of array, a height x width x 3 numpy array of
+        uint8 (or anything else that offers its bytes that way).  No pixels are copied:
+        changes to the image show up in the array and the other way around.  The array
+        must be C-contiguous, so a slice such as arr[:, ::2] has to be copied first."""
+        super(ArrayImage, self).__init__(array = array)
+
+class MappedImage(AbstractImage):
+    _map = None     # copies of a MappedImage keep their pixels in memory, not in the file
+
+    def __init__(self, fname, writable=False, width=None, height=None, offset=0, mode="RGB"):
+        """Use the pixels of a binary ppm (P6) or pgm (P5, an L image) file where they are on
+        disk, through a memory map, instead of reading the file.  Only the parts of the
+        file that are used are read, so images larger than memory can be worked on a
+        region or a tile at a time (see tiles).  With writable=True, changes to the image
+        are made in the file.  For a file of raw pixel bytes with no header, give its
+        width, height and mode, and offset, the number of bytes before the first pixel."""
+        import mmap
+        if not isinstance(fname, str):
+            raise TypeError("Error: file name %r not a string" % fname)
+        bands = _checkMode(mode)
+        with open(fname, 'r+b' if writable else 'rb') as f:
+            if width is None and height is None:
+                width, height, bands = _readPPMHeader(f)
+                offset = f.tell()
+            if width is None or height is None:
+                raise TypeError("Error: give both the width and height of a raw file")
+            _checkPositive("width", width)
+            _checkPositive("height", height)
+            size = width * height * bands
+            if os.fstat(f.fileno()).st_size < offset + size:
+                raise ValueError("Error: %s is too short for a %dx%d image" % (fname, width, height))
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        shape = (height, width) if bands == 1 else (height, width, bands)
+        view = memoryview(self._map)[offset:offset + size].cast("B", shape)
+        super(MappedImage, self).__init__(array = view)
+        self.imFileName = fname
+        self._offset = offset
+
+    def flush(self):
+        """Make sure the changes made to the image are written to the file"""
+        if self._map is not None:
+            self._map.flush()
+
+    def close(self):
+        """Write any changes to the file and unmap it.  The image can not be used after this.
+        Arrays made from the image by toArray use the file's memory too, so they must be
+        deleted first."""
+        if self._map is not None:
+            self._map.flush()
+            self._im.release()
+            try:
+                self._map.close()
+            except BufferError:
+                # keep the image usable
+                size = self.width * self.height * self._bands
+                self._im = memoryview(self._map)[self._offset:self._offset + size]
+                raise ValueError("Error: arrays made by toArray still use the pixels of %s; "
+                                 "delete them before closing it" % self.imFileName) from None
+            self._im = None
+            self._map = None
+
+def fromArray(array):
+    """Return an ArrayImage sharing the memory of array"""
+    return ArrayImage(array)
+
 class EmptyImage(AbstractImage):
-    def __init__(self,cols,rows):
+    def __init__(self,cols,rows,mode="RGB"):
         if not isinstance(cols, int):
             raise TypeError("Error: width %r not an integer" % cols)
         if cols <= 0:
@@ -573,7 +2401,7 @@ class EmptyImage(AbstractImage):
             raise TypeError("Error: height %r not an integer" % rows)
         if rows <= 0:
             raise ValueError("Error: height %d not positive" % rows)
-        super(EmptyImage, self).__init__(height = rows, width = cols)
+        super(EmptyImage, self).__init__(height = rows, width = cols, mode = mode)
 
 class ListImage(AbstractImage):
     def __init__(self,thelist):
@@ -582,8 +2410,367 @@ class ListImage(AbstractImage):
         # to be much point in adding error checking.
         super(ListImage, self).__init__(data=thelist)
 
+# Decoded images kept by cacheImages, so loading the same file again skips decoding it.
+# The key is the file's absolute path, modification time and size, and how it was loaded.
+_fileCache = collections.OrderedDict()  # key -> image holding the pixels, oldest used first
+_fileCacheBytes = 0
+_fileCacheLimit = 0     # most bytes of pixels kept, 0 when the cache is off
+_fileCacheStats = {"hits": 0, "misses": 0, "evictions": 0}
+_fileCacheLock = None
+
+def cacheImages(maxBytes=None):
+    """Return and optionally change the most bytes of decoded pixels kept by the file
+    cache.  While it is on (maxBytes above 0), loading a file that is in the cache, with
+    the same maxSize, scale and mode, shares its pixels instead of decoding it again.  A
+    file that has changed since it was cached is decoded again.  Images share the cached
+    pixels until they are changed, so changes never reach the cache.  When the pixels
+    come to more than maxBytes, the images used longest ago are dropped.  0 turns the
+    cache off and empties it."""
+    global _fileCacheLimit, _fileCacheLock
+    oldSetting = _fileCacheLimit
+    if maxBytes is not None:
+        if not isinstance(maxBytes, int):
+            raise TypeError("Error: maxBytes %r is not a whole number of bytes" % (maxBytes,))
+        if maxBytes < 0:
+            raise ValueError("Error: maxBytes %r is negative" % (maxBytes,))
+        if _fileCacheLock is None:
+            import threading
+            _fileCacheLock = threading.Lock()
+        with _fileCacheLock:
+            _fileCacheLimit = maxBytes
+            _trimFileCache()
+    return oldSetting
+
+def cacheStats():
+    """Return the file cache's counts of hits and misses (loads that did and did not find
+    the file in the cache) and evictions, with its number of images and bytes, as a dict"""
+    res = dict(_fileCacheStats)
+    res.update(images=len(_fileCache), bytes=_fileCacheBytes, maxBytes=_fileCacheLimit)
+    return res
+
+def _trimFileCache():
+    global _fileCacheBytes
+    while _fileCache and _fileCacheBytes > _fileCacheLimit:
+        key, img = _fileCache.popitem(last=False)
+        _fileCacheBytes -= img.width * img.height * img._bands
+        _fileCacheStats["evictions"] += 1
+
+def _fileCacheKey(img, fname, maxSize, scale):
+    st = os.stat(fname)
+    return (os.path.abspath(fname), st.st_mtime_ns, st.st_size, img.mode, img._backend,
+            None if maxSize is None else tuple(maxSize), scale)
+
+def _loadCached(img, fname, maxSize, scale):
+    """Give img the pixels of fname from the file cache and return True, or if they are
+    not there, remember where to put them once img has decoded them and return False"""
+    if not _fileCacheLimit:
+        return False
+    key = _fileCacheKey(img, fname, maxSize, scale)
+    with _fileCacheLock:
+        cached = _fileCache.get(key)
+        if cached is not None:
+            _fileCache.move_to_end(key)
+            _fileCacheStats["hits"] += 1
+            img._shareWith(cached)
+            return True
+        _fileCacheStats["misses"] += 1
+    img._fileKey = key
+    return False
+
+def _storeCached(img):
+    """Put the pixels img has just decoded in the file cache"""
+    global _fileCacheBytes
+    key = img._fileKey
+    img._fileKey = None
+    size = img.width * img.height * img._bands
+    with _fileCacheLock:
+        if key in _fileCache or size > _fileCacheLimit:
+            return
+        _fileCache[key] = img.copy()    # shares the pixels, so img copies them to change them
+        _fileCacheBytes += size
+        _trimFileCache()
+
+# every image not yet garbage collected; starting or stopping a profile rebinds their methods
+_liveImages = weakref.WeakSet()
+_profiling = None
+
+def _onePixel(args, kwargs, result):
+    return 1
+
+def _imagePixels(args, kwargs, result):
+    return args[0].width * args[0].height
+
+def _resultPixels(args, kwargs, result):
+    return result.width * result.height
+
+def _bytesPixels(args, kwargs, result):
+    return len(result) // args[0]._bands
+
+def _dataPixels(args, kwargs, result):
+    return memoryview(kwargs.get('data', args[-1])).nbytes // args[0]._bands
+
+# the operations a profile times: (class, attribute, name in the report, how to count the
+# pixels a call works on).  Classes and tkinter are looked up when the profile starts.
+_profiledOperations = [
+    ('Pixel', '__init__', 'Pixel', _onePixel),
+    ('Pixel', '_fromTrusted', 'Pixel', _onePixel),
+    ('AbstractImage', 'getPILPixel', 'getPixel', _onePixel),
+    ('AbstractImage', 'getBufferPixel', 'getPixel', _onePixel),
+    ('AbstractImage', 'setPILPixel', 'setPixel', _onePixel),
+    ('AbstractImage', 'setBufferPixel', 'setPixel', _onePixel),
+    ('AbstractImage', 'getPILPixels', 'getPixels', _bytesPixels),
+    ('AbstractImage', 'getBufferPixels', 'getPixels', _bytesPixels),
+    ('AbstractImage', 'setPILPixels', 'setPixels', _dataPixels),
+    ('AbstractImage', 'setBufferPixels', 'setPixels', _dataPixels),
+    ('AbstractImage', '_decode', 'load', _imagePixels),
+    ('AbstractImage', 'copy', 'copy', _imagePixels),
+    ('AbstractImage', 'toList', 'toList', _imagePixels),
+    ('AbstractImage', 'mapChannels', 'mapChannels', _imagePixels),
+    ('AbstractImage', 'mapPixels', 'mapPixels', _imagePixels),
+    ('AbstractImage', 'parallelMap', 'parallelMap', _imagePixels),
+    ('AbstractImage', 'convolve', 'convolve', _imagePixels),
+    ('AbstractImage', 'convert', 'convert', _imagePixels),
+    ('AbstractImage', 'resize', 'resize', _resultPixels),
+    ('AbstractImage', 'crop', 'crop', _resultPixels),
+    ('AbstractImage', 'flipH', 'flipH', _imagePixels),
+    ('AbstractImage', 'flipV', 'flipV', _imagePixels),
+    ('AbstractImage', 'rotate90', 'rotate90', _imagePixels),
+    ('AbstractImage', '_arithmetic', 'arithmetic', _imagePixels),
+    ('AbstractImage', 'blend', 'blend', _imagePixels),
+    ('AbstractImage', 'composite', 'composite', _imagePixels),
+    ('AbstractImage', '_computeHistogram', 'histogram', _imagePixels),
+    ('AbstractImage', 'draw', 'draw', _imagePixels),
+    ('AbstractImage', '_encodePreview', 'notebook preview', _imagePixels),
+    ('AbstractImage', '_frame', 'setDelay frame', _imagePixels),
+    ('AbstractImage', '_getPhoto', 'draw: update photo', _imagePixels),
+    ('AbstractImage', '_saveFile', 'save', _imagePixels),
+    ('ImageWin', '__init__', 'ImageWin', None),
+    ('ImageWin', 'getMouse', 'getMouse', None),
+    ('Tk', 'update', 'Tk update', None),
+]
+
+class Profile:
+    """Counts the calls of the main image operations and adds up the time they take,
+    while it is running.  Start one with profile().  The time of an operation includes
+    the operations it calls, for example draw includes the Tk update."""
+
+    def __init__(self):
+        self.stats = {}     # operation name -> [calls, seconds, pixels]
+        self._saved = []    # (class, attribute, what it was before the profile started)
+
+    def start(self):
+        """Start counting.  Only one profile can run at a time."""
+        global _profiling
+        if _profiling is not None:
+            raise RuntimeError("Error: a profile is already running")
+        from functools import wraps
+        from time import perf_counter
+
+        def timed(func, stat, pixels):
+            @wraps(func)
+            def timedFunc(*args, **kwargs):
+                start = perf_counter()
+                result = func(*args, **kwargs)
+                stat[1] += perf_counter() - start
+                stat[0] += 1
+                if pixels is not None:
+                    stat[2] += pixels(args, kwargs, result)
+                return result
+            return timedFunc
+
+        owners = {'Pixel': Pixel, 'AbstractImage': AbstractImage, 'ImageWin': ImageWin,
+                  'Tk': tkinter.Tk if tkinter is not None else None}
+        for ownerName, attribute, name, pixels in _profiledOperations:
+            owner = owners[ownerName]
+            if owner is None or owner is object:
+                continue
+            stat = self.stats.setdefault(name, [0, 0.0, 0])
+            saved = owner.__dict__.get(attribute)
+            if isinstance(saved, classmethod):
+                setattr(owner, attribute, classmethod(timed(saved.__func__, stat, pixels)))
+            else:
+                setattr(owner, attribute, timed(getattr(owner, attribute), stat, pixels))
+            self._saved.append((owner, attribute, saved))
+        _profiling = self
+        self._rebind()
+
+    def stop(self):
+        """Stop counting and put the operations back the way they were"""
+        global _profiling
+        if _profiling is not self:
+            return
+        for owner, attribute, saved in reversed(self._saved):
+            if saved is None:
+                delattr(owner, attribute)   # it was inherited
+            else:
+                setattr(owner, attribute, saved)
+        self._saved = []
+        _profiling = None
+        self._rebind()
+
+    def _rebind(self):
+        # images hold their pixel methods bound to themselves, so bind them again
+        for img in list(_liveImages):
+            img._bindBackend(img._backend)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def report(self):
+        """Return a table of the operations called, slowest total time first"""
+        lines = ["%-20s %10s %10s %10s %14s" % ("operation", "calls", "seconds", "us/call", "pixels/s")]
+        for name, (calls, seconds, pixels) in sorted(self.stats.items(), key=lambda s: -s[1][1]):
+            if calls == 0:
+                continue
+            rate = "%14.0f" % (pixels / seconds) if pixels and seconds else "%14s" % ""
+            lines.append("%-20s %10d %10.4f %10.2f %s"
+                         % (name, calls, seconds, seconds / calls * 1e6, rate))
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.report()
+
+def profile():
+    """Start counting and timing calls of the image operations, and return the Profile
+    doing it.  Use it in a with statement, or call its stop method, then print it:
+
+        with image.profile() as prof:
+            ... work with images ...
+        print(prof)
+
+    When no profile is running the operations are not slowed down at all."""
+    prof = Profile()
+    prof.start()
+    return prof
+
+def _grayPixel(p):
+    avg = (p.getRed() + p.getGreen() + p.getBlue()) // 3
+    return Pixel._fromTrusted(avg, avg, avg)
+
+def _negative(img):
+    img.mapChannels(lambda v: 255 - v)
+    return img
+
+# the transforms the command line knows by name; each takes an image and returns the result
+transforms = {
+    'copy': lambda img: img,
+    'negative': _negative,
+    'grayscale': lambda img: img.mapPixels(_grayPixel),
+}
+
+def _getTransform(name):
+    """Return the transform called name, or for module:function, a transform that applies
+    the Pixel function from that module to every pixel"""
+    if name in transforms:
+        return transforms[name]
+    if ':' not in name:
+        raise ValueError("Error: unknown transform %r, use one of %s or module:function"
+                         % (name, ", ".join(sorted(transforms))))
+    import importlib
+    moduleName, funcName = name.split(':', 1)
+    func = getattr(importlib.import_module(moduleName), funcName)
+    return lambda img: img.mapPixels(func)
+
+def _startWorker():
+    """Set up a command line worker process, which must never open a window"""
+    os.environ["CIMAGE_HEADLESS"] = "1"
+    headless(True)
+
+def _positiveInt(text):
+    """argparse type for a whole number above 0"""
+    import argparse
+    try:
+        value = int(text)
+    except ValueError:
+        value = 0
+    if value <= 0:
+        raise argparse.ArgumentTypeError("%r is not a positive whole number" % text)
+    return value
+
+def _transformFile(fname, outDir, transformName, ftype):
+    """Transform one file for the command line, in a worker process.  Returns the number
+    of pixels in the image."""
+    img = FileImage(fname)
+    result = _getTransform(transformName)(img)
+    base = os.path.basename(fname)
+    if ftype:
+        base = os.path.splitext(base)[0] + '.' + ftype
+    result.save(os.path.join(outDir, base))
+    return img.getWidth() * img.getHeight()
+
+def main(args=None):
+    """Command line entry point: transform many image files with a pool of worker processes.
+    Run python -m image --help for the options."""
+    import argparse
+    import glob
+    import sys
+    import time
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+    parser = argparse.ArgumentParser(prog="python -m image",
+                                     description="Apply a transform to many image files.")
+    parser.add_argument("inputs", nargs="+", help="image files or glob patterns such as 'photos/*.jpg'")
+    parser.add_argument("-o", "--output", required=True, help="directory for the results")
+    parser.add_argument("-t", "--transform", default="copy",
+                        help="%s, or module:function for a function from Pixel to Pixel (default copy)"
+                             % ", ".join(sorted(transforms)))
+    parser.add_argument("-f", "--format", help="file type to save as, such as png (default: keep the type)")
+    parser.add_argument("-w", "--workers", type=_positiveInt, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: one per CPU)")
+    options = parser.parse_args(args)
+
+    try:
+        _getTransform(options.transform)
+    except (ValueError, ImportError, AttributeError) as e:
+        parser.error(str(e))
+    fnames = []
+    for pattern in options.inputs:
+        fnames.extend(sorted(glob.glob(pattern, recursive=True)) or [pattern])
+    os.makedirs(options.output, exist_ok=True)
+
+    done = pixels = failed = 0
+    start = time.perf_counter()
+    # the workers are made headless by _startWorker, leaving this process as it was
+    with ProcessPoolExecutor(options.workers, initializer=_startWorker) as pool:
+        # keep a few files per worker in flight, not the whole list
+        pending = {}
+        todo = iter(fnames)
+        while True:
+            for fname in todo:
+                future = pool.submit(_transformFile, fname, options.output, options.transform, options.format)
+                pending[future] = fname
+                if len(pending) >= 2 * options.workers:
+                    break
+            if not pending:
+                break
+            finished, notDone = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                fname = pending.pop(future)
+                try:
+                    pixels += future.result()
+                    done += 1
+                except Exception as e:
+                    failed += 1
+                    print("Error: %s: %s" % (fname, e), file=sys.stderr)
+    seconds = time.perf_counter() - start
+
+    print("%d images, %d pixels in %.2f s: %.1f images/s, %.0f pixels/s"
+          % (done, pixels, seconds, done / seconds, pixels / seconds))
+    if failed:
+        print("%d images failed" % failed, file=sys.stderr)
+        return 1
+    return 0
+
 # Example program  Read in an image and calulate the negative.
+# With arguments, process image files from the command line instead (see main).
 if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        sys.exit(main())
+
     win = ImageWin(480, 640, "Image Processing")
     original_iamge = FileImage('lcastle.gif')
 
@@ -6,8 +6,9 @@ from setuptools import setup
 setup(
     name='cImage',
     description='Image manipulation library for media computation education',
-    version='2.0.1',
+    version='2.1',
     py_modules = ['image'],
+    entry_points = {'console_scripts': ['cimage = image:main']},
     author = 'Brad Miller and Dan Schellenberg',
     author_email = 'bonelake@mac.com',
     install_requires= ['Pillow>=2.9.0'],
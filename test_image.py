@@ -0,0 +1,690 @@
+"""Tests of the image module.  Run with python -m pytest."""
+
+import contextlib
+import gc
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import image
+
+
+def tempFile(test, name, data):
+    """Write data to a file called name in a temporary directory that is removed after
+    the test, returning its path"""
+    d = tempfile.TemporaryDirectory()
+    test.addCleanup(d.cleanup)
+    fname = os.path.join(d.name, name)
+    with open(fname, "wb") as f:
+        f.write(data)
+    return fname
+
+
+# the ways the image module can do bulk work: with PIL, with numpy, or in pure Python
+ENGINES = ("PIL", "numpy", "Python")
+
+@contextlib.contextmanager
+def engine(name):
+    """Make the image module use only the engine name while the block runs"""
+    numpy = image._numpy
+    with mock.patch.object(image, "pilAvailable", name == "PIL"), \
+         mock.patch.object(image, "_numpy", numpy if name == "numpy" else lambda: None):
+        yield
+
+def patterned(width, height, mode="RGB"):
+    """Return an image whose pixels all differ, in mode"""
+    bands = image._modeBands[mode]
+    img = image.EmptyImage(width, height, mode)
+    img.setPixels(0, 0, width, height, bytes((i * 37 + i // 7) % 256 for i in range(width * height * bands)))
+    return img
+
+
+class PPMTest(unittest.TestCase):
+
+    def testHeader(self):
+        f = io.BytesIO(b"P6\n5 4\n255\n" + bytes(60))
+        self.assertEqual(image._readPPMHeader(f), (5, 4, 3))
+        self.assertEqual(f.tell(), 11)
+        self.assertEqual(image._readPPMHeader(io.BytesIO(b"P5 2 3 255 " + bytes(6))), (2, 3, 1))
+
+    def testComment(self):
+        f = io.BytesIO(b"P6\n# made by hand\n2 1\n# max\n255\n" + bytes(range(6)))
+        self.assertEqual(image._readPPMHeader(f), (2, 1, 3))
+        self.assertEqual(image._readPPMPixels(f, 2, 1, 3), bytearray(range(6)))
+
+    def testTruncatedHeader(self):
+        for data in (b"P6 5 4 255", b"P6\n5 4\n25", b"P6\n5"):
+            with self.assertRaisesRegex(ValueError, "ends in the middle of its header"):
+                image._readPPMHeader(io.BytesIO(data))
+        fname = tempFile(self, "short.ppm", b"P6 5 4 255")
+        with self.assertRaisesRegex(ValueError, "ends in the middle of its header"):
+            image.MappedImage(fname)
+
+    def testMissingPixels(self):
+        with self.assertRaisesRegex(ValueError, "missing some of its pixels"):
+            image._readPPMPixels(io.BytesIO(bytes(5)), 2, 1, 3)
+
+    def testNotPPM(self):
+        with self.assertRaisesRegex(ValueError, "not a binary ppm"):
+            image._readPPMHeader(io.BytesIO(b"P3 1 1 255 0 0 0"))
+
+
+class ConvolveTest(unittest.TestCase):
+
+    def testEnginesAgree(self):
+        kernels = ([[1, 2, 1], [2, 4, 2], [1, 2, 1]],          # separable, 3x3
+                   [[0, -1, 0], [-1, 5, -1], [0, -1, 0]],      # not separable
+                   [[1] * 5] * 5,
+                   [[1, 1, 1, 1, 1, 1, 1]])                    # one row, not square
+        for mode in ("RGB", "L"):
+            for kernel in kernels:
+                results = {}
+                for name in ENGINES:
+                    with engine(name):
+                        results[name] = patterned(11, 8, mode).convolve(kernel).getPixels()
+                self.assertEqual(results["numpy"], results["Python"], (mode, kernel))
+                self.assertEqual(results["PIL"], results["Python"], (mode, kernel))
+
+    def testEdgesRepeat(self):
+        for name in ENGINES:
+            with engine(name):
+                img = image.EmptyImage(5, 5)
+                self.assertEqual(img.blur(2).getPixels(), img.getPixels(), name)
+                self.assertEqual(img.sobel().extrema(), ((0, 0),) * 3, name)
+
+    def testSobel(self):
+        results = {}
+        for name in ENGINES:
+            with engine(name):
+                results[name] = patterned(9, 6).sobel().getPixels()
+        self.assertEqual(results["numpy"], results["Python"])
+        self.assertEqual(results["PIL"], results["Python"])
+
+    def testArguments(self):
+        img = image.EmptyImage(3, 3)
+        self.assertRaises(TypeError, img.blur, 1.5)
+        self.assertRaises(ValueError, img.blur, 0)
+        self.assertRaises(ValueError, img.convolve, [[1, 1]])
+        self.assertRaises(TypeError, img.convolve, [["a"]])
+        self.assertRaises(ValueError, img.convolve, [[1, -1, 0]], scale=0)
+
+
+class GeometryTest(unittest.TestCase):
+
+    def testResizeBilinear(self):
+        self.assertEqual(image._resizeBilinear(bytes([0, 255]), (2, 1), (4, 1), 1),
+                         bytearray([0, 64, 191, 255]))
+        self.assertEqual(image._resizeBilinear(bytes([7, 8, 9]) * 4, (2, 2), (5, 3)),
+                         bytearray([7, 8, 9]) * 15)
+
+    def testResizeNearest(self):
+        self.assertEqual(image._resizeNearest(bytes([1, 2, 3, 4]), (2, 2), (4, 4), 1),
+                         bytearray([1, 1, 2, 2] * 2 + [3, 3, 4, 4] * 2))
+        self.assertEqual(image._resizeNearest(bytes(range(16)), (4, 4), (2, 2), 1),
+                         bytearray([5, 7, 13, 15]))
+
+    def testEnginesAgree(self):
+        for mode in ("RGB", "L", "RGBA"):
+            results = {}
+            for name in ("PIL", "Python"):
+                with engine(name):
+                    img = patterned(7, 5, mode)
+                    results[name] = [img.flipH().getPixels(), img.flipV().getPixels(),
+                                     img.crop(1, 2, 3, 2).getPixels(),
+                                     img.resize(14, 10).getPixels()]
+                    results[name] += [img.rotate90(k).getPixels() for k in range(4)]
+            self.assertEqual(results["PIL"], results["Python"], mode)
+
+    def testRotate(self):
+        for name in ("PIL", "Python"):
+            with engine(name):
+                img = image.EmptyImage(2, 1, "L")
+                img.setPixels(0, 0, 2, 1, bytes([1, 2]))
+                turned = img.rotate90()
+                self.assertEqual((turned.getWidth(), turned.getHeight()), (1, 2))
+                self.assertEqual(bytes(turned.getPixels()), bytes([2, 1]), name)
+                self.assertEqual(bytes(img.rotate90(-1).getPixels()), bytes([1, 2]), name)
+
+    def testArguments(self):
+        img = image.EmptyImage(3, 3)
+        self.assertRaises(TypeError, img.resize, "a", 3)
+        self.assertRaises(ValueError, img.resize, 0, 3)
+        self.assertRaises(ValueError, img.resize, 3, 3, "cubic")
+        self.assertRaises(TypeError, img.rotate90, 1.0)
+
+
+class SetDelayTest(unittest.TestCase):
+
+    def testFrames(self):
+        frames = []
+        img = image.EmptyImage(10, 3)
+        img._items = {"window": 1}     # as if drawn, without a display
+        with mock.patch.object(image.AbstractImage, "draw", lambda self, win: frames.append(win)):
+            img.setDelay(0, 5)
+            for x in range(10):
+                for y in range(3):
+                    img.setPixel(x, y, image.Pixel(0, 0, 0))
+        self.assertEqual(len(frames), 6)
+        self.assertEqual(tuple(img.getPixel(9, 2)), (0, 0, 0))
+        img.setDelay(None)
+        self.assertNotEqual(img.setPixel.__func__.__name__, "_animatedSetPixel")
+
+    def testArguments(self):
+        img = image.EmptyImage(3, 3)
+        self.assertRaises(TypeError, img.setDelay, "a")
+        self.assertRaises(TypeError, img.setDelay, 1, "a")
+        self.assertRaises(TypeError, img.setDelay, 1, 1, "a")
+        self.assertRaises(ValueError, img.setDelay, -1)
+        self.assertRaises(ValueError, img.setDelay, 1, 1, 0)
+
+
+class RGBAFilterTest(unittest.TestCase):
+
+    def testFiltersKeepAlpha(self):
+        for name in ENGINES:
+            with engine(name):
+                img = patterned(9, 7, "RGBA")
+                alpha = img.getPixels()[3::4]
+                rgb = img.convert("RGB")
+                for filtered, colors in ((img.sobel(), rgb.sobel()),
+                                         (img.blur(), rgb.blur()),
+                                         (img.convolve([[-1, -1, -1], [-1, 8, -1], [-1, -1, -1]]),
+                                          rgb.convolve([[-1, -1, -1], [-1, 8, -1], [-1, -1, -1]]))):
+                    self.assertEqual(filtered.mode, "RGBA")
+                    self.assertEqual(filtered.getPixels()[3::4], alpha, name)
+                    self.assertEqual(filtered.convert("RGB").getPixels(), colors.getPixels(), name)
+
+
+class MappedImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fname = tempFile(self, "a.ppm", b"P6\n4 3\n255\n" + bytes(range(36)))
+
+    def testReadOnly(self):
+        img = image.MappedImage(self.fname)
+        self.addCleanup(img.close)
+        self.assertEqual(tuple(img.getPixel(1, 0)), (3, 4, 5))
+        self.assertEqual(img.toArray()[0, 1].tolist(), [3, 4, 5])
+        for write in (lambda: img.setPixel(0, 0, image.Pixel(1, 2, 3)),
+                      lambda: img.setPixels(0, 0, 1, 1, bytes(3))):
+            with self.assertRaisesRegex(TypeError, "writable=True"):
+                write()
+
+    def testWritable(self):
+        img = image.MappedImage(self.fname, writable=True)
+        for x, y, tile in img.tiles(2, 2):
+            tile.setPixel(0, 0, image.Pixel(255, 0, 0))
+        img.close()
+        with open(self.fname, "rb") as f:
+            data = f.read()[11:]
+        self.assertEqual(data[:3], b"\xff\0\0")
+        self.assertEqual(data[6:9], b"\xff\0\0")
+
+    def testRawFile(self):
+        fname = tempFile(self, "a.raw", bytes(2) + bytes(range(12)))
+        img = image.MappedImage(fname, width=2, height=2, offset=2)
+        self.addCleanup(img.close)
+        self.assertEqual(tuple(img.getPixel(1, 1)), (9, 10, 11))
+        gray = image.MappedImage(fname, width=4, height=3, offset=2, mode="L")
+        self.addCleanup(gray.close)
+        self.assertEqual(gray.getPixels(0, 1, 4, 1), bytes([4, 5, 6, 7]))
+        self.assertRaises(TypeError, image.MappedImage, fname, width=2)
+        self.assertRaises(TypeError, image.MappedImage, fname, width=2, height="2")
+        self.assertRaises(ValueError, image.MappedImage, fname, width=2, height=0)
+        self.assertRaisesRegex(ValueError, "too short", image.MappedImage, fname, width=3, height=3)
+
+    def testTiles(self):
+        img = patterned(5, 4)
+        seen = []
+        for x, y, tile in img.tiles(2, 3):
+            seen.append((x, y, tile.getWidth(), tile.getHeight()))
+            self.assertEqual(tile.getPixels(), img.getPixels(x, y, tile.getWidth(), tile.getHeight()))
+        self.assertEqual(seen, [(0, 0, 2, 3), (2, 0, 2, 3), (4, 0, 1, 3),
+                                (0, 3, 2, 1), (2, 3, 2, 1), (4, 3, 1, 1)])
+        self.assertRaises(TypeError, lambda: next(img.tiles(2.5)))
+        self.assertRaises(ValueError, lambda: next(img.tiles(0)))
+        self.assertRaises(ValueError, lambda: next(img.tiles(2, -1)))
+
+    def testCloseWithArray(self):
+        img = image.MappedImage(self.fname)
+        array = img.toArray()
+        with self.assertRaisesRegex(ValueError, "delete them"):
+            img.close()
+        self.assertEqual(tuple(img.getPixel(1, 0)), (3, 4, 5))
+        del array
+        img.close()
+
+
+class CopyOnWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.img = image.EmptyImage(4, 3)
+        self.img.setPixel(1, 1, image.Pixel(10, 20, 30))
+
+    def testCopiesDoNotSeeChanges(self):
+        c = self.img.copy()
+        self.assertIs(c._im, self.img._im)
+        c.setPixel(1, 1, image.Pixel(1, 2, 3))
+        self.img.setPixel(2, 2, image.Pixel(4, 5, 6))
+        self.assertEqual(tuple(self.img.getPixel(1, 1)), (10, 20, 30))
+        self.assertEqual(tuple(c.getPixel(2, 2)), (255, 255, 255))
+
+    def testDiscardedCopyGivesItsShareBack(self):
+        self.img.copy()
+        gc.collect()
+        pixels = self.img._im
+        self.img.setPixel(0, 0, image.Pixel(0, 0, 0))
+        self.assertIs(self.img._im, pixels)     # written in place, not copied
+
+    def testChangedCopyGivesItsShareBack(self):
+        c = self.img.copy()
+        c.setPixel(0, 0, image.Pixel(0, 0, 0))
+        pixels = self.img._im
+        self.img.setPixel(0, 0, image.Pixel(1, 1, 1))
+        self.assertIs(self.img._im, pixels)
+        self.assertEqual(tuple(c.getPixel(0, 0)), (0, 0, 0))
+
+    def testSaveAsyncSnapshotGivesItsShareBack(self):
+        with tempfile.TemporaryDirectory() as d:
+            self.img.saveAsync(os.path.join(d, "a.png")).result()
+        gc.collect()
+        pixels = self.img._im
+        self.img.setPixel(0, 0, image.Pixel(0, 0, 0))
+        self.assertIs(self.img._im, pixels)
+
+    def testEvictedCacheEntryGivesItsShareBack(self):
+        with tempfile.TemporaryDirectory() as d:
+            fname = os.path.join(d, "a.png")
+            self.img.save(fname)
+            old = image.cacheImages(1 << 20)
+            try:
+                loaded = image.FileImage(fname)
+                loaded.getPixels()
+                image.cacheImages(0)
+            finally:
+                image.cacheImages(old)
+        gc.collect()
+        pixels = loaded._im
+        loaded.setPixel(0, 0, image.Pixel(0, 0, 0))
+        self.assertIs(loaded._im, pixels)
+
+
+class ChangedBoxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.img = image.EmptyImage(6, 5)
+        self.img._dirty = None
+
+    def testWriteGrowsTheChangedBox(self):
+        self.img.setPixel(1, 0, image.Pixel(0, 0, 0))
+        self.assertEqual(self.img._dirty, [1, 0, 2, 1])
+        self.img.setPixel(3, 2, image.Pixel(0, 0, 0))
+        self.assertEqual(self.img._dirty, [1, 0, 4, 3])
+
+    def testRegions(self):
+        self.img.setPixels(2, 1, 3, 2, bytes(18))
+        self.assertEqual(self.img._dirty, [2, 1, 5, 3])
+        self.img.mapChannels(lambda v: 255 - v)
+        self.assertEqual(self.img._dirty, [0, 0, 6, 5])
+
+    def testNegativeIndex(self):
+        self.img.setPixel(-1, -1, image.Pixel(0, 0, 0))
+        self.assertEqual(self.img._dirty, [5, 4, 6, 5])
+
+
+class CommandLineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.src = tempFile(self, "in.ppm", b"P6\n2 1\n255\n" + bytes((0, 10, 20, 200, 210, 255)))
+        out = tempfile.TemporaryDirectory()
+        self.addCleanup(out.cleanup)
+        self.out = out.name
+
+    def runMain(self, *args):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return image.main([self.src, "-o", self.out, "-w", "1"] + list(args))
+
+    def testNegative(self):
+        self.assertEqual(self.runMain("-t", "negative", "-f", "png"), 0)
+        result = image.FileImage(os.path.join(self.out, "in.png"))
+        self.assertEqual(result.getPixels(), bytearray((255, 245, 235, 55, 45, 0)))
+
+    def testLeavesThisProcessAsItWas(self):
+        setting = image.headless()
+        with mock.patch.dict(os.environ, {"CIMAGE_HEADLESS": ""}):
+            self.runMain()
+            self.assertEqual(os.environ["CIMAGE_HEADLESS"], "")
+        self.assertEqual(image.headless(), setting)
+
+    def testBadOptions(self):
+        for args in (["-w", "0"], ["-w", "two"], ["-t", "nonesuch"]):
+            with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+                self.runMain(*args)
+
+    def testMissingFile(self):
+        self.src = os.path.join(self.out, "nonesuch.ppm")
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            self.assertEqual(self.runMain(), 1)
+        self.assertIn("nonesuch.ppm", err.getvalue())
+
+
+class StatsTest(unittest.TestCase):
+
+    def testEnginesAgree(self):
+        for mode in ("L", "RGB", "RGBA"):
+            data = patterned(5, 3, mode).getPixels()
+            bands = image._modeBands[mode]
+            expected = tuple(tuple(data[c::bands].count(v) for v in range(256)) for c in range(bands))
+            for name in ENGINES:
+                with engine(name):
+                    img = image.EmptyImage(5, 3, mode)
+                    img.setPixels(0, 0, 5, 3, data)
+                    self.assertEqual(img.histogram(), expected, (mode, name))
+
+    def testMeanAndExtrema(self):
+        img = image.EmptyImage(2, 1, "L")
+        img.setPixels(0, 0, 2, 1, bytes((10, 31)))
+        self.assertEqual(img.mean(), (20.5,))
+        self.assertEqual(img.extrema(), ((10, 31),))
+
+    def testRemembered(self):
+        img = patterned(4, 4)
+        with mock.patch.object(img, "_computeHistogram", wraps=img._computeHistogram) as compute:
+            img.histogram()
+            img.mean()
+            img.extrema()
+            self.assertEqual(compute.call_count, 1)
+
+    def testWriteForgetsStatistics(self):
+        img = image.EmptyImage(2, 1)
+        img.setPixel(1, 0, image.Pixel(10, 20, 30))
+        self.assertEqual(img.extrema()[0], (10, 255))
+        img.setPixel(0, 0, image.Pixel(0, 0, 0))
+        self.assertEqual(img.extrema()[0], (0, 10))
+
+    def testOutsideArrayIsNotRemembered(self):
+        import numpy
+        array = numpy.zeros((1, 2), dtype=numpy.uint8)
+        img = image.fromArray(array)
+        self.assertEqual(img.extrema(), ((0, 0),))
+        array[0, 1] = 9
+        self.assertEqual(img.extrema(), ((0, 9),))
+
+
+class ModeTest(unittest.TestCase):
+
+    def testGray(self):
+        self.assertEqual(image._gray(0, 0, 0), 0)
+        self.assertEqual(image._gray(255, 255, 255), 255)
+        self.assertEqual(image._gray(255, 0, 0), 76)
+        self.assertEqual(image._gray(0, 255, 0), 150)
+        self.assertEqual(image._gray(0, 0, 255), 29)
+
+    def testEnginesAgree(self):
+        for mode in ("L", "RGB", "RGBA"):
+            data = patterned(5, 3, mode).getPixels()
+            for newMode in ("L", "RGB", "RGBA"):
+                results = []
+                for name in ENGINES:
+                    with engine(name):
+                        img = image.EmptyImage(5, 3, mode)
+                        img.setPixels(0, 0, 5, 3, data)
+                        converted = img.convert(newMode)
+                        self.assertEqual(converted.mode, newMode)
+                        results.append(converted.getPixels())
+                self.assertEqual(results, [results[0]] * len(ENGINES), (mode, newMode))
+
+    def testConversions(self):
+        img = image.EmptyImage(2, 1, "RGBA")
+        img.setPixels(0, 0, 2, 1, bytes((255, 0, 0, 40, 10, 20, 30, 255)))
+        self.assertEqual(img.convert("RGB").getPixels(), bytearray((255, 0, 0, 10, 20, 30)))
+        gray = img.convert("L")
+        self.assertEqual(gray.getPixels(), bytearray((76, 18)))
+        self.assertEqual(gray.convert("RGBA").getPixels(), bytearray((76, 76, 76, 255, 18, 18, 18, 255)))
+
+    def testPixels(self):
+        img = image.EmptyImage(1, 1, "L")
+        img.setPixel(0, 0, image.Pixel(255, 0, 0))
+        self.assertEqual(img.getPixel(0, 0).getColorTuple(), (76, 76, 76))
+
+    def testUnknownMode(self):
+        with self.assertRaisesRegex(ValueError, "^Error: mode 'CMYK'"):
+            image.EmptyImage(1, 1).convert("CMYK")
+
+
+class ArithmeticTest(unittest.TestCase):
+
+    def combine(self, name, mode, func):
+        """Return the pixels of func(a, b, mask) for two patterned images in mode and a gray
+        mask, worked out with the engine name"""
+        first, second = patterned(5, 3, mode), patterned(5, 3, mode).flipH()
+        with engine(name):
+            a = image.EmptyImage(5, 3, mode)
+            a.setPixels(0, 0, 5, 3, first.getPixels())
+            b = image.EmptyImage(5, 3, mode)
+            b.setPixels(0, 0, 5, 3, second.getPixels())
+            mask = image.EmptyImage(5, 3, "L")
+            mask.setPixels(0, 0, 5, 3, bytes(range(0, 255, 17)))
+            return func(a, b, mask).getPixels()
+
+    def testEnginesAgree(self):
+        funcs = {
+            "add": lambda a, b, m: a + b,
+            "subtract": lambda a, b, m: a - b,
+            "multiply": lambda a, b, m: a * b,
+            "numbers": lambda a, b, m: 255 - (a * 1.5 + 20),
+            "blend": lambda a, b, m: a.blend(b, 0.3),
+            "composite": lambda a, b, m: a.composite(b, m),
+        }
+        for mode in ("L", "RGB", "RGBA"):
+            for op, func in funcs.items():
+                results = [self.combine(name, mode, func) for name in ENGINES]
+                self.assertEqual(results, [results[0]] * len(ENGINES), (mode, op))
+
+    def testValues(self):
+        a = image.EmptyImage(1, 1, "RGBA")
+        a.setPixels(0, 0, 1, 1, bytes((200, 100, 0, 50)))
+        b = image.EmptyImage(1, 1, "RGBA")
+        b.setPixels(0, 0, 1, 1, bytes((100, 150, 255, 255)))
+        self.assertEqual((a + b).getPixels(), bytearray((255, 250, 255, 50)))
+        self.assertEqual((a - b).getPixels(), bytearray((100, 0, 0, 50)))
+        self.assertEqual((a * b).getPixels(), bytearray((78, 58, 0, 50)))
+        self.assertEqual(a.blend(b, 0).getPixels(), a.getPixels())
+        self.assertEqual(a.blend(b, 1).getPixels(), b.getPixels())
+
+    def testErrors(self):
+        img = image.EmptyImage(2, 2)
+        with self.assertRaisesRegex(TypeError, "^Error: alpha '0.5' is not a number"):
+            img.blend(img, "0.5")
+        with self.assertRaisesRegex(ValueError, "^Error: alpha 2 is not between 0 and 1"):
+            img.blend(img, 2)
+        with self.assertRaisesRegex(ValueError, "not the same size"):
+            img + image.EmptyImage(2, 3)
+        with self.assertRaisesRegex(TypeError, "is not an image"):
+            img.composite(img, "mask")
+        with self.assertRaises(TypeError):
+            img + "text"
+
+
+class PNGTest(unittest.TestCase):
+
+    def decode(self, data):
+        from PIL import Image as PILImage
+        im = PILImage.open(io.BytesIO(data))
+        return im.mode, im.size, im.tobytes()
+
+    def testEncode(self):
+        for mode in ("L", "RGB", "RGBA"):
+            data = patterned(5, 3, mode).getPixels()
+            for level in (-1, 0, 9):
+                png = image._pngBytes(data, 5, 3, image._modeBands[mode], level)
+                self.assertEqual(self.decode(png), (mode, (5, 3), bytes(data)))
+
+    def testPreview(self):
+        for mode in ("L", "RGB", "RGBA"):
+            for name in ENGINES:
+                with engine(name):
+                    img = patterned(6, 4, mode)
+                    self.assertEqual(self.decode(img._repr_png_()),
+                                     (mode, (6, 4), bytes(img.getPixels())), (mode, name))
+
+    def testShrunkPreview(self):
+        for name in ENGINES:
+            with engine(name):
+                img = patterned(40, 20)
+                img.previewSize = (10, 10)
+                self.assertEqual(self.decode(img._repr_png_())[1], (10, 5), name)
+                self.assertIn('width="10" height="5"', img._repr_html_())
+
+    def testRemembered(self):
+        img = patterned(6, 4)
+        png = img._repr_png_()
+        self.assertIs(img._repr_png_(), png)
+        img.setPixel(0, 0, image.Pixel(1, 2, 3))
+        self.assertEqual(self.decode(img._repr_png_())[2][:3], b"\x01\x02\x03")
+
+
+class SaveTest(unittest.TestCase):
+
+    def setUp(self):
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        self.dir = d.name
+
+    def testToBytes(self):
+        for mode in ("L", "RGB", "RGBA"):
+            for name in ENGINES:
+                with engine(name):
+                    img = patterned(5, 3, mode)
+                    data = img.toBytes()
+                loaded = image.FileImage(tempFile(self, "a.png", data), mode=mode)
+                self.assertEqual(loaded.getPixels(), img.getPixels(), (mode, name))
+
+    def testPPM(self):
+        for name in ("numpy", "Python"):
+            with engine(name):
+                self.assertEqual(patterned(2, 1, "L").toBytes("ppm")[:11], b"P5\n2 1\n255\n")
+                rgba = patterned(2, 1, "RGBA")
+                self.assertEqual(rgba.toBytes("PPM"), b"P6\n2 1\n255\n" + rgba.convert("RGB").getPixels())
+
+    def testSave(self):
+        for name in ENGINES:
+            with engine(name):
+                img = patterned(4, 3)
+                fname = os.path.join(self.dir, name + ".png")
+                img.save(fname)
+            self.assertEqual(image.FileImage(fname).getPixels(), img.getPixels(), name)
+        img.save(os.path.join(self.dir, "b"), "png")
+        self.assertTrue(os.path.exists(os.path.join(self.dir, "b.png")))
+
+    def testSaveAsync(self):
+        img = patterned(4, 3)
+        pixels = img.getPixels()
+        future = img.saveAsync(os.path.join(self.dir, "a.png"))
+        img.setPixel(0, 0, image.Pixel(1, 2, 3))
+        fname = future.result()
+        self.assertEqual(fname, os.path.join(self.dir, "a.png"))
+        self.assertEqual(image.FileImage(fname).getPixels(), pixels)
+
+    def testErrors(self):
+        img = patterned(4, 3)
+        with self.assertRaisesRegex(ValueError, "^Error: give the name of the file"):
+            img.save()
+        with self.assertRaises(OSError):
+            img.save(os.path.join(self.dir, "missing", "a.png"))
+        with self.assertRaises(OSError):
+            img.saveAsync(os.path.join(self.dir, "missing", "a.png")).result()
+        with engine("Python"):
+            with self.assertRaisesRegex(ValueError, "^Error: without PIL, only"):
+                img.toBytes("jpg")
+
+
+class FileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fname = tempFile(self, "a.ppm", b"P6\n2 1\n255\n" + bytes(range(6)))
+        self.addCleanup(image.cacheImages, image.cacheImages(1 << 20))
+        self.start = image.cacheStats()
+
+    def counts(self):
+        stats = image.cacheStats()
+        return tuple(stats[k] - self.start[k] for k in ("hits", "misses", "evictions"))
+
+    def testHitsAndMisses(self):
+        first = image.FileImage(self.fname)
+        self.assertEqual(first.getPixels(), bytearray(range(6)))
+        second = image.FileImage(self.fname)
+        self.assertEqual(second.getPixels(), bytearray(range(6)))
+        image.FileImage(self.fname, mode="L").getPixels()
+        self.assertEqual(self.counts(), (1, 2, 0))
+        self.assertEqual(image.cacheStats()["images"], 2)
+
+    def testChangesDoNotReachTheCache(self):
+        image.FileImage(self.fname).setPixel(0, 0, image.Pixel(9, 9, 9))
+        self.assertEqual(image.FileImage(self.fname).getPixel(0, 0).getColorTuple(), (0, 1, 2))
+
+    def testChangedFileIsDecodedAgain(self):
+        image.FileImage(self.fname).getPixels()
+        with open(self.fname, "wb") as f:
+            f.write(b"P6\n1 1\n255\n" + bytes((7, 8, 9)))
+        self.assertEqual(image.FileImage(self.fname).getPixels(), bytearray((7, 8, 9)))
+        self.assertEqual(self.counts(), (0, 2, 0))
+
+    def testEviction(self):
+        image.FileImage(self.fname).getPixels()
+        image.cacheImages(5)
+        self.assertEqual(self.counts(), (0, 1, 1))
+        self.assertEqual(image.cacheStats()["bytes"], 0)
+        image.FileImage(self.fname).getPixels()
+        self.assertEqual(image.cacheStats()["images"], 0)
+
+    def testErrors(self):
+        with self.assertRaisesRegex(TypeError, "^Error: maxBytes 1.5 is not a whole number"):
+            image.cacheImages(1.5)
+        with self.assertRaisesRegex(ValueError, "^Error: maxBytes -1 is negative"):
+            image.cacheImages(-1)
+
+
+class LoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fname = tempFile(self, "a.ppm", b"P6\n8 4\n255\n" + bytes(range(96)))
+
+    def testPixelsAreReadWhenUsed(self):
+        for name in ENGINES:
+            with engine(name):
+                img = image.FileImage(self.fname)
+                self.assertEqual((img.getWidth(), img.getHeight()), (8, 4))
+                self.assertIsNotNone(img._pending, name)
+                self.assertEqual(img.getPixels(), bytearray(range(96)), name)
+                self.assertIsNone(img._pending, name)
+
+    def testShrink(self):
+        for name in ENGINES:
+            with engine(name):
+                img = image.FileImage(self.fname, maxSize=(4, 4))
+                self.assertEqual((img.getWidth(), img.getHeight()), (4, 2), name)
+                self.assertEqual(len(img.getPixels()), 4 * 2 * 3, name)
+                img = image.FileImage(self.fname, scale=0.25)
+                self.assertEqual((img.getWidth(), img.getHeight()), (2, 1), name)
+                self.assertEqual(len(img.getPixels()), 2 * 1 * 3, name)
+        self.assertEqual(image._fitSize((8, 4), maxSize=(100, 100)), (8, 4))
+
+    def testErrors(self):
+        with self.assertRaisesRegex(ValueError, "^Error: give maxSize or scale, not both"):
+            image.FileImage(self.fname, maxSize=(4, 4), scale=0.5)
+        for maxSize in ((4,), (4, 2.5), 4):
+            with self.assertRaisesRegex(TypeError, "^Error: maxSize .* is not a \\(width, height\\) pair"):
+                image.FileImage(self.fname, maxSize=maxSize)
+        with self.assertRaisesRegex(ValueError, "^Error: maxSize \\(4, 0\\) is not positive"):
+            image.FileImage(self.fname, maxSize=(4, 0))
+        with self.assertRaisesRegex(TypeError, "^Error: scale '1' is not a number"):
+            image.FileImage(self.fname, scale="1")
+        with self.assertRaisesRegex(ValueError, "^Error: scale 2 is not between 0 and 1"):
+            image.FileImage(self.fname, scale=2)
+
+
+if __name__ == '__main__':
+    unittest.main()